@@ -8,3 +8,6 @@
 '''
 import project
 import company
+import search
+import outbox
+import digest
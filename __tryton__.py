@@ -17,6 +17,8 @@
         'urls.xml',
         'company.xml',
         'project.xml',
+        'outbox.xml',
+        'digest.xml',
     ],
     'translation': [
     ],
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+    activity
+
+    The activity of works: their history, timesheet lines, attachments and
+    commits merged in a single stream, newest first
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import json
+import heapq
+import calendar
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from utils import rule_filtered_sql
+
+
+class ActivityStream(object):
+    """
+    Paginates the activity of a set of works with a cursor. Every source is
+    queried for at most one page of entries older than the cursor, already
+    sorted, and the results are merged with a heap. A page costs the same
+    whatever its position in the stream.
+
+    The entries are ordered by their create date, then by their source (in
+    the order of :attr:`SOURCES`) and then by their id, all descending.
+
+    Like search, the record rules of the user apply: the works and the
+    entries of every source which the user cannot read are left out.
+
+    :param works_query: A SQL query selecting the ids of the project.work
+                        records whose activity is streamed
+    :param works_args: The arguments of the query
+    :param cursor: The opaque token of the page to display. None displays
+                   the newest entries.
+    :param per_page: Number of entries in a page
+    :param sources: The models included in the stream
+    """
+    is_keyset = True
+
+    #: The models which make the activity
+    SOURCES = (
+        'project.work.history', 'timesheet.line', 'ir.attachment',
+        'project.work.commit',
+    )
+
+    def __init__(self, works_query, works_args, cursor=None, per_page=20,
+            sources=SOURCES):
+        self.works_query = works_query
+        self.works_args = works_args
+        self.cursor = cursor
+        self.per_page = per_page
+        self.sources = sources
+        self._items = None
+        self._next_cursor = None
+        #: Only older entries are paginated
+        self.prev_cursor = None
+
+    @staticmethod
+    def encode_cursor(create_date, rank, record_id):
+        """
+        Returns an opaque token for the position of an entry
+        """
+        return urlsafe_b64encode(json.dumps([
+            create_date.strftime('%Y-%m-%dT%H:%M:%S.%f'), rank, record_id
+        ]))
+
+    @staticmethod
+    def decode_cursor(token):
+        """
+        Returns the create date, rank and id from a token built by
+        :meth:`encode_cursor`. Invalid tokens return None.
+        """
+        try:
+            create_date, rank, record_id = json.loads(
+                urlsafe_b64decode(str(token))
+            )
+            return (
+                datetime.strptime(create_date, '%Y-%m-%dT%H:%M:%S.%f'),
+                int(rank), int(record_id)
+            )
+        except (TypeError, ValueError):
+            return None
+
+    def _works_filter(self):
+        """
+        Returns the SQL query and its arguments which select the ids of the
+        works whose activity is streamed and which the user can read
+        """
+        work_table = Pool().get('project.work')._table
+        from_, where, args = rule_filtered_sql('project.work', [])
+        if not where:
+            return self.works_query, list(self.works_args)
+        return 'SELECT "' + work_table + '".id' + from_ + where + \
+            ' AND "' + work_table + '".id IN (' + self.works_query + ')', \
+            args + list(self.works_args)
+
+    def _source_filter(self, model):
+        """
+        Returns the SQL condition and its arguments which select the
+        records of the model belonging to the works and allowed by the
+        record rules
+        """
+        work_table = Pool().get('project.work')._table
+        works_query, args = self._works_filter()
+        if model == 'timesheet.line':
+            condition = 'work IN (SELECT work FROM "' + work_table + '" ' \
+                'WHERE id IN (' + works_query + '))'
+        elif model == 'ir.attachment':
+            condition = "resource IN (SELECT 'project.work,' || " \
+                'CAST(id AS VARCHAR) FROM "' + work_table + '" ' \
+                'WHERE id IN (' + works_query + '))'
+        else:
+            condition = 'project IN (' + works_query + ')'
+
+        domain1, domain2 = Pool().get('ir.rule').domain_get(model, mode='read')
+        if domain1:
+            condition += ' AND ' + domain1
+            args.extend(domain2)
+        return condition, args
+
+    def _fetch(self, model, rank, position):
+        """
+        Returns the (create date, id) of the newest entries of a source
+        which are older than the position, newest first
+        """
+        cursor = Transaction().cursor
+        condition, args = self._source_filter(model)
+        args = list(args)
+        if position:
+            create_date, position_rank, record_id = position
+            if rank < position_rank:
+                condition += ' AND create_date <= %s'
+                args.append(create_date)
+            elif rank == position_rank:
+                condition += ' AND (create_date < %s ' \
+                    'OR (create_date = %s AND id < %s))'
+                args.extend([create_date, create_date, record_id])
+            else:
+                condition += ' AND create_date < %s'
+                args.append(create_date)
+        cursor.execute(
+            'SELECT create_date, id FROM "' + Pool().get(model)._table + '" '
+            'WHERE ' + condition + ' '
+            'ORDER BY create_date DESC, id DESC LIMIT %s',
+            args + [self.per_page + 1]
+        )
+        return cursor.fetchall()
+
+    @staticmethod
+    def _heap_key(create_date, rank, record_id):
+        # heapq is a min heap, so the key of the newest entry is the lowest
+        timestamp = calendar.timegm(create_date.timetuple()) * 1000000 + \
+            create_date.microsecond
+        return (-timestamp, -rank, -record_id)
+
+    def _load(self):
+        position = self.cursor and self.decode_cursor(self.cursor) or None
+
+        results = [
+            self._fetch(model, rank, position)
+            for rank, model in enumerate(self.sources)
+        ]
+
+        # k-way merge of the sorted results
+        heap = []
+        for rank, rows in enumerate(results):
+            if rows:
+                create_date, record_id = rows[0]
+                heapq.heappush(heap, (
+                    self._heap_key(create_date, rank, record_id), rank, 0
+                ))
+        merged = []
+        while heap and len(merged) <= self.per_page:
+            _, rank, index = heapq.heappop(heap)
+            create_date, record_id = results[rank][index]
+            merged.append((create_date, rank, record_id))
+            if index + 1 < len(results[rank]):
+                create_date, record_id = results[rank][index + 1]
+                heapq.heappush(heap, (
+                    self._heap_key(create_date, rank, record_id),
+                    rank, index + 1
+                ))
+
+        if len(merged) > self.per_page:
+            merged = merged[:self.per_page]
+            self._next_cursor = self.encode_cursor(*merged[-1])
+
+        # Read the records of each source at once
+        ids_by_rank = {}
+        for _, rank, record_id in merged:
+            ids_by_rank.setdefault(rank, []).append(record_id)
+        records = {}
+        for rank, ids in ids_by_rank.iteritems():
+            for record in self._get_records(self.sources[rank], ids):
+                records[(rank, record.id)] = record
+        self._items = [
+            records[(rank, record_id)] for _, rank, record_id in merged
+        ]
+
+    def _get_records(self, model, ids):
+        """
+        Returns the records of the model to display for the ids. The
+        attachments are read as summaries, which never load the data of
+        the files.
+        """
+        if model == 'ir.attachment':
+            return Pool().get('project.work').get_attachment_summaries_by_id(
+                ids
+            ).values()
+        return Pool().get(model).browse(ids)
+
+    def items(self):
+        if self._items is None:
+            self._load()
+        return self._items
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def __len__(self):
+        return len(self.items())
+
+    @property
+    def next_cursor(self):
+        "The token of the page of older entries, None on the last page"
+        self.items()
+        return self._next_cursor
@@ -56,6 +56,11 @@ app.config.update(CONFIG)
 app.initialise()
 app.jinja_env.globals.update({'json': json, 'sample': random.sample})
 
+# Render reStructuredText in the templates with the cached renderer of the
+# module, so that the pages and the previews share the HTML and settings
+from trytond.modules.nereid_project.utils import rst_to_html
+app.jinja_env.filters['rst'] = rst_to_html
+
 
 babelized_app = Babel(app)
 application = babelized_app.app.wsgi_app
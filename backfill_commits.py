@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    backfill_commits
+
+    Links the commits of a local git repository to the tasks referenced in
+    their messages, for the commits which were never received by a hook.
+    Running it again over the same repository does not duplicate commits.
+
+    Usage::
+
+        python backfill_commits.py -c /etc/trytond.conf -d database \\
+            -n nereid-project -u https://github.com/openlabs/nereid-project \\
+            --commit-url https://github.com/openlabs/nereid-project/commit/%s \\
+            /path/to/nereid-project
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+from argparse import ArgumentParser
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('-c', '--config', dest='config',
+        help='Path of the Tryton configuration file')
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-n', '--repository', dest='repository',
+        required=True, help='Name of the repository')
+    parser.add_argument('-u', '--repository-url', dest='repository_url',
+        required=True)
+    parser.add_argument('--commit-url', dest='commit_url', required=True,
+        help='URL of a commit with %%s in place of the hash')
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+        default=5000)
+    parser.add_argument('repo_path', help='Path of the git repository')
+    options = parser.parse_args()
+
+    from trytond.config import CONFIG
+    if options.config:
+        CONFIG.update_etc(options.config)
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(options.database)
+    pool.init()
+
+    total = 0
+    with Transaction().start(options.database, 0) as transaction:
+        commit_obj = pool.get('project.work.commit')
+        for count in commit_obj.backfill_from_git(
+                options.repo_path, options.repository,
+                options.repository_url, options.commit_url,
+                options.batch_size):
+            # Every batch is committed, so an interrupted backfill keeps
+            # what it did and can simply be run again
+            transaction.cursor.commit()
+            total += count
+            sys.stdout.write('%d commits linked\r' % total)
+            sys.stdout.flush()
+    sys.stdout.write('%d commits linked\n' % total)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,10 @@
 from nereid import request
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pyson import Eval, Get
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from utils import request_cache
 
 
 class Company(ModelSQL, ModelView):
@@ -24,6 +28,11 @@ class Company(ModelSQL, ModelView):
         'Project Administrators'
     )
 
+    def write(self, ids, vals):
+        if 'project_admins' in vals:
+            request_cache('project_admin').clear()
+        return super(Company, self).write(ids, vals)
+
 Company()
 
 
@@ -39,6 +48,18 @@ class CompanyProjectAdmins(ModelSQL):
         'nereid.user', 'User', select=1, required=True
     )
 
+    def create(self, vals):
+        Pool().get('project.work')._all_participant_ids.reset()
+        return super(CompanyProjectAdmins, self).create(vals)
+
+    def write(self, ids, vals):
+        Pool().get('project.work')._all_participant_ids.reset()
+        return super(CompanyProjectAdmins, self).write(ids, vals)
+
+    def delete(self, ids):
+        Pool().get('project.work')._all_participant_ids.reset()
+        return super(CompanyProjectAdmins, self).delete(ids)
+
 CompanyProjectAdmins()
 
 
@@ -58,14 +79,23 @@ class NereidUser(ModelSQL, ModelView):
 
     def is_project_admin(self, user):
         """
-        Returns True if the user is in the website admins list
+        Returns True if the user is in the website admins list. The result
+        is memoized for the rest of the request.
 
         :param user: Browse record of the user
         :return: True
         """
-        if user in request.nereid_website.company.project_admins:
-            return True
-        return False
+        cache = request_cache('project_admin')
+        if user.id not in cache:
+            company_admin_obj = Pool().get('company.company-nereid.user')
+            cursor = Transaction().cursor
+            cursor.execute(
+                'SELECT id FROM "' + company_admin_obj._table + '" '
+                'WHERE company = %s AND "user" = %s',
+                (request.nereid_website.company.id, user.id)
+            )
+            cache[user.id] = bool(cursor.fetchone())
+        return cache[user.id]
 
 
 NereidUser()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+    digest
+
+    Participants who opted in for a digest of a project do not get an email
+    for every update of its tasks. The updates are kept as pending
+    notifications and a cron job sends one email per recipient and project
+    with all the updates made within the digest window.
+
+    The fragment of every update is rendered once, while the request which
+    made the update is served, and shared by all the recipients.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.header import Header
+
+from nereid import render_template
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+
+#: Default digest window in minutes. This can be changed with the
+#: project_digest_window option of the Tryton configuration.
+DIGEST_WINDOW = 30
+
+
+def get_digest_window():
+    """
+    Returns the time for which the updates are accumulated before a digest
+    is sent
+    """
+    return timedelta(
+        minutes=int(CONFIG.get('project_digest_window') or DIGEST_WINDOW)
+    )
+
+
+class Notification(ModelSQL):
+    "Pending Notification"
+    _name = 'project.work.notification'
+    _description = __doc__
+
+    date = fields.DateTime('Date', required=True, select=True)
+    project = fields.Many2One(
+        'project.work', 'Project', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    task = fields.Many2One(
+        'project.work', 'Task', required=True, ondelete='CASCADE'
+    )
+    history = fields.Many2One(
+        'project.work.history', 'History', ondelete='CASCADE'
+    )
+    text = fields.Text('Text')
+    html = fields.Text('HTML')
+    recipients = fields.One2Many(
+        'project.work.notification.recipient', 'notification', 'Recipients'
+    )
+
+    def default_date(self):
+        return datetime.utcnow()
+
+    def defer(self, task, users, history=None):
+        """
+        Keeps an update of a task for the digest of the given users. This
+        must be called in the request which made the update.
+
+        :param task: Browse record of the task
+        :param users: Browse records of the nereid users
+        :param history: Browse record of the history line of the update.
+                        None when the task was created.
+        """
+        if not users:
+            return None
+        fragment = None
+        if history:
+            # The same fragment as in the thread of the notification emails
+            fragment = Pool().get('project.work.history').get_email_fragment(
+                history.id
+            )
+        return self.create({
+            'project': task.parent.id,
+            'task': task.id,
+            'history': history and history.id or None,
+            'text': unicode(render_template(
+                'project/emails/digest-update-text.jinja',
+                task=task, fragment=fragment
+            )),
+            'html': unicode(render_template(
+                'project/emails/digest-update-html.jinja',
+                task=task, fragment=fragment
+            )),
+            'recipients': [
+                ('create', {'user': user.id}) for user in users
+            ],
+        })
+
+    def _build_message(self, user, project, rows):
+        """
+        Returns the digest email of a recipient
+
+        :param user: Browse record of the recipient
+        :param project: Browse record of the project
+        :param rows: The text and HTML fragments of the updates
+        """
+        subject = '[%s] %d update(s)' % (project.name, len(rows))
+        message = MIMEMultipart('alternative')
+        message['Subject'] = Header(subject, 'utf-8')
+        message['From'] = CONFIG['smtp_from']
+        message['To'] = user.email
+        message.attach(MIMEText(
+            u'\n\n'.join(text or u'' for text, _ in rows).encode('utf-8'),
+            'plain', 'utf-8'
+        ))
+        message.attach(MIMEText(
+            u'<hr/>'.join(html or u'' for _, html in rows).encode('utf-8'),
+            'html', 'utf-8'
+        ))
+        return message
+
+    def send_digests(self):
+        """
+        Queues a digest for every recipient and project whose oldest pending
+        update is older than the digest window. This is called by the cron
+        job.
+        """
+        pool = Pool()
+        recipient_obj = pool.get('project.work.notification.recipient')
+        outbox_obj = pool.get('project.work.outbox')
+        nereid_user_obj = pool.get('nereid.user')
+        project_obj = pool.get('project.work')
+        cursor = Transaction().cursor
+
+        cursor.execute(
+            'SELECT r."user", n.project '
+            'FROM "' + recipient_obj._table + '" AS r '
+            'JOIN "' + self._table + '" AS n ON n.id = r.notification '
+            'GROUP BY r."user", n.project '
+            'HAVING MIN(n.date) <= %s',
+            (datetime.utcnow() - get_digest_window(),)
+        )
+        groups = cursor.fetchall()
+        if not groups:
+            return True
+
+        users = dict(
+            (u.id, u) for u in nereid_user_obj.browse(
+                list(set(g[0] for g in groups))
+            )
+        )
+        projects = dict(
+            (p.id, p) for p in project_obj.browse(
+                list(set(g[1] for g in groups))
+            )
+        )
+        for user_id, project_id in groups:
+            cursor.execute(
+                'SELECT r.id, n.text, n.html '
+                'FROM "' + recipient_obj._table + '" AS r '
+                'JOIN "' + self._table + '" AS n ON n.id = r.notification '
+                'WHERE r."user" = %s AND n.project = %s '
+                'ORDER BY n.date, n.id', (user_id, project_id)
+            )
+            rows = cursor.fetchall()
+            user = users[user_id]
+            if user.email:
+                outbox_obj.queue_mail(
+                    CONFIG['smtp_from'], [user.email], self._build_message(
+                        user, projects[project_id],
+                        [(text, html) for _, text, html in rows]
+                    )
+                )
+            recipient_obj.delete([row[0] for row in rows])
+
+        # The updates which were sent to all their recipients
+        cursor.execute(
+            'SELECT n.id FROM "' + self._table + '" AS n '
+            'WHERE NOT EXISTS ('
+                'SELECT 1 FROM "' + recipient_obj._table + '" AS r '
+                'WHERE r.notification = n.id'
+            ')'
+        )
+        sent_ids = [row[0] for row in cursor.fetchall()]
+        if sent_ids:
+            self.delete(sent_ids)
+        return True
+
+Notification()
+
+
+class NotificationRecipient(ModelSQL):
+    "Pending Notification Recipient"
+    _name = 'project.work.notification.recipient'
+    _description = __doc__
+
+    notification = fields.Many2One(
+        'project.work.notification', 'Notification', required=True,
+        select=True, ondelete='CASCADE'
+    )
+    user = fields.Many2One(
+        'nereid.user', 'User', required=True, select=True,
+        ondelete='CASCADE'
+    )
+
+NotificationRecipient()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+    filestore
+
+    Access to the files of the attachments kept in the Tryton file store
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import hashlib
+import tempfile
+from mimetypes import guess_type
+
+from flask import Response
+from nereid import request
+from werkzeug.wsgi import wrap_file
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+
+#: Size of the blocks in which the files are streamed
+BLOCK_SIZE = 64 * 1024
+
+#: Default maximum size of an uploaded file in bytes. This can be changed
+#: with the max_attachment_size option of the Tryton configuration.
+MAX_ATTACHMENT_SIZE = 100 * 1024 * 1024
+
+
+class FileTooLarge(Exception):
+    "The file is larger than the maximum size allowed"
+
+
+def get_max_size():
+    """
+    Returns the maximum size in bytes of an uploaded file
+    """
+    return int(CONFIG.get('max_attachment_size') or MAX_ATTACHMENT_SIZE)
+
+
+def get_filename(digest, collision=0):
+    """
+    Returns the path of a file in the file store of the current database.
+    This is the same layout ir.attachment uses to store its data.
+
+    :param digest: The hex digest of the content of the file
+    :param collision: The collision number of the digest
+    """
+    filename = digest
+    if collision:
+        filename = filename + '-' + str(collision)
+    return os.path.join(
+        CONFIG['data_path'], Transaction().cursor.database_name,
+        filename[0:2], filename[2:4], filename
+    )
+
+
+def _same_content(filename1, filename2):
+    """
+    Compares the content of two files block by block
+    """
+    with open(filename1, 'rb') as file1:
+        with open(filename2, 'rb') as file2:
+            while True:
+                data1, data2 = file1.read(BLOCK_SIZE), file2.read(BLOCK_SIZE)
+                if data1 != data2:
+                    return False
+                if not data1:
+                    return True
+
+
+def store_stream(stream, max_size=None):
+    """
+    Copies a stream into the file store in blocks, so the file is never
+    held in memory. Files are addressed by the md5 digest of their content
+    like ir.attachment does, so identical files uploaded to different tasks
+    are stored only once.
+
+    :param stream: A file like object to read from
+    :param max_size: The maximum size allowed. FileTooLarge is raised as
+                     soon as the stream is found to be larger.
+    :return: A tuple of the digest, the collision number and the size
+    """
+    directory = os.path.join(
+        CONFIG['data_path'], Transaction().cursor.database_name
+    )
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0770)
+
+    md5 = hashlib.md5()
+    size = 0
+    file_d, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.upload-')
+    try:
+        with os.fdopen(file_d, 'wb') as file_p:
+            while True:
+                data = stream.read(BLOCK_SIZE)
+                if not data:
+                    break
+                size += len(data)
+                if max_size and size > max_size:
+                    raise FileTooLarge()
+                md5.update(data)
+                file_p.write(data)
+
+        digest = md5.hexdigest()
+        collision = 0
+        while True:
+            filename = get_filename(digest, collision)
+            if not os.path.exists(filename):
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename), 0770)
+                os.rename(tmp_filename, filename)
+                break
+            if _same_content(filename, tmp_filename):
+                # The file is already in the store
+                os.unlink(tmp_filename)
+                break
+            collision += 1
+    except:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        raise
+    return digest, collision, size
+
+
+def _iter_range(file_p, length):
+    """
+    Yields the next length bytes of the file in blocks and closes it
+    """
+    try:
+        while length > 0:
+            data = file_p.read(min(BLOCK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        file_p.close()
+
+
+def send_stored_file(filename, download_name, etag, last_modified):
+    """
+    Returns a response which streams the file from the file store without
+    loading it in memory. Conditional requests are answered with a 304 and
+    a single byte range with a 206.
+
+    :param filename: The path of the file
+    :param download_name: The name of the file proposed to the user
+    :param etag: The entity tag of the file
+    :param last_modified: The datetime of the last change of the file
+    """
+    headers = {
+        'Content-Disposition': 'attachment; filename="%s"' % \
+            download_name.replace('"', '').encode('utf-8'),
+        'Accept-Ranges': 'bytes',
+    }
+    mimetype = guess_type(download_name)[0] or 'application/octet-stream'
+
+    response = Response(
+        mimetype=mimetype, headers=headers, direct_passthrough=True
+    )
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+
+    if (request.if_none_match and request.if_none_match.contains(etag)) or \
+            (not request.if_none_match and request.if_modified_since and \
+                request.if_modified_since >= last_modified.replace(
+                    microsecond=0)):
+        response.status_code = 304
+        return response
+
+    size = os.path.getsize(filename)
+    file_p = open(filename, 'rb')
+
+    byte_range = request.range
+    if_range = request.headers.get('If-Range')
+    if byte_range and byte_range.units == 'bytes' and \
+            len(byte_range.ranges) == 1 and \
+            (not if_range or if_range.strip('"') == etag):
+        begin, end = byte_range.ranges[0]
+        if begin < 0:
+            # A suffix range like bytes=-500
+            begin, end = max(size + begin, 0), size
+        elif end is None or end > size:
+            end = size
+        if begin >= end:
+            file_p.close()
+            response.status_code = 416
+            response.headers['Content-Range'] = 'bytes */%d' % size
+            return response
+
+        file_p.seek(begin)
+        response.response = _iter_range(file_p, end - begin)
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            begin, end - 1, size
+        )
+        response.content_length = end - begin
+        return response
+
+    response.response = wrap_file(request.environ, file_p, BLOCK_SIZE)
+    response.content_length = size
+    return response
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+    outbox
+
+    Emails are not sent from within the request. They are queued in the
+    outbox and sent by a cron job which reuses a single SMTP connection for
+    a batch of messages and retries failed messages with an exponential
+    backoff.
+
+    The messages are sent with the SMTP server of the Tryton configuration
+    (smtp_server, smtp_port...), so a local stand-in like
+    `python -m smtpd -n -c DebuggingServer localhost:1025` can be used in
+    development and tests.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import socket
+import smtplib
+from datetime import datetime, timedelta
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.tools import get_smtp_server
+from trytond.transaction import Transaction
+
+#: Delay in seconds before the first retry of a message. The delay doubles
+#: with every failed attempt.
+RETRY_DELAY = 60
+
+#: Number of attempts after which a message is given up
+MAX_ATTEMPTS = 8
+
+#: Number of days the sent and failed messages are kept
+RETENTION_DAYS = 30
+
+
+class Outbox(ModelSQL, ModelView):
+    "Email Outbox"
+    _name = 'project.work.outbox'
+    _description = __doc__
+    _order = [('id', 'ASC')]
+
+    from_addr = fields.Char('From', required=True)
+    #: The recipients separated by commas
+    to_addrs = fields.Text('To', required=True)
+    #: The complete message as it is sent to the SMTP server
+    message = fields.Text('Message', required=True)
+    state = fields.Selection([
+        ('outbox', 'Outbox'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', select=True)
+    sent_date = fields.DateTime('Sent Date', readonly=True)
+    last_error = fields.Text('Last Error', readonly=True)
+
+    def default_state(self):
+        return 'outbox'
+
+    def default_attempts(self):
+        return 0
+
+    def default_next_attempt(self):
+        return datetime.utcnow()
+
+    def queue_mail(self, from_addr, to_addrs, message):
+        """
+        Queues a message to be sent by the cron job and returns the ID of
+        the queued message. This is what the request handlers call instead
+        of talking to the SMTP server.
+
+        :param from_addr: The address of the sender
+        :param to_addrs: List of the addresses of the recipients
+        :param message: The email message, as returned by render_email
+        """
+        if not to_addrs:
+            return None
+        return self.create({
+            'from_addr': from_addr,
+            'to_addrs': ','.join(to_addrs),
+            'message': message.as_string(),
+        })
+
+    def get_smtp_server(self):
+        """
+        Returns a connected SMTP server. Override this to send the messages
+        some other way.
+        """
+        return get_smtp_server()
+
+    def _retry_later(self, mail, error):
+        """
+        Records a failed attempt and schedules the next one, or gives up
+        the message when it failed too many times
+
+        :param mail: Browse record of the message
+        :param error: The exception raised while sending
+        """
+        attempts = mail.attempts + 1
+        values = {
+            'attempts': attempts,
+            'last_error': unicode(error) or error.__class__.__name__,
+        }
+        permanent = isinstance(error, smtplib.SMTPResponseException) and \
+            error.smtp_code >= 500
+        if permanent or attempts >= MAX_ATTEMPTS:
+            values['state'] = 'failed'
+        else:
+            values['next_attempt'] = datetime.utcnow() + timedelta(
+                seconds=RETRY_DELAY * 2 ** (attempts - 1)
+            )
+        self.write(mail.id, values)
+
+    def send_all(self, limit=100):
+        """
+        Sends the queued messages which are due, oldest first, over a single
+        SMTP connection, and purges the old sent and failed messages. This
+        is called by the cron job.
+
+        When the connection or the login fails, whatever the reply of the
+        server, nothing is sent and the messages are left for the next run
+        without counting an attempt: the failure is not theirs.
+
+        :param limit: The maximum number of messages sent in one batch
+        """
+        self.purge()
+
+        ids = self.search([
+            ('state', '=', 'outbox'),
+            ('next_attempt', '<=', datetime.utcnow()),
+        ], order=[('next_attempt', 'ASC'), ('id', 'ASC')], limit=limit)
+        if not ids:
+            return True
+
+        try:
+            server = self.get_smtp_server()
+        except (smtplib.SMTPException, socket.error):
+            return True
+
+        try:
+            for mail in self.browse(ids):
+                try:
+                    server.sendmail(
+                        mail.from_addr, mail.to_addrs.split(','),
+                        mail.message.encode('utf-8')
+                    )
+                except (smtplib.SMTPServerDisconnected, socket.error), error:
+                    # The server went away. The remaining messages are left
+                    # as they are for the next run.
+                    self._retry_later(mail, error)
+                    break
+                except smtplib.SMTPException, error:
+                    self._retry_later(mail, error)
+                else:
+                    self.write(mail.id, {
+                        'state': 'sent',
+                        'sent_date': datetime.utcnow(),
+                    })
+        finally:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+        return True
+
+    def purge(self):
+        """
+        Deletes the messages sent or given up more than RETENTION_DAYS ago,
+        so that the bodies of the messages do not pile up
+        """
+        cursor = Transaction().cursor
+        cursor.execute(
+            'DELETE FROM "' + self._table + '" '
+            'WHERE state IN (%s, %s) AND write_date < %s',
+            ('sent', 'failed',
+                datetime.now() - timedelta(days=RETENTION_DAYS))
+        )
+
+Outbox()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+    pagination
+
+    Pagination helpers for the task lists
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, date
+
+from nereid.contrib.pagination import Pagination
+
+
+class RankedPagination(Pagination):
+    """
+    Paginates the records matched by a full text search in the order of
+    their rank. The domain is expected to already restrict the records to
+    the ranked ids.
+    """
+
+    def __init__(self, obj, domain, ranked_ids, page, per_page):
+        super(RankedPagination, self).__init__(obj, domain, page, per_page)
+        self.ranked_ids = ranked_ids
+
+    def items(self):
+        matched_ids = set(self.obj.search(self.domain))
+        ids = [i for i in self.ranked_ids if i in matched_ids]
+        offset = (self.page - 1) * self.per_page
+        return self.obj.browse(ids[offset:offset + self.per_page])
+
+
+class KeysetPagination(object):
+    """
+    Paginates the records with a cursor on the sort field and the id
+    instead of an offset. Fetching any page costs the same as fetching the
+    first one, and the pages do not shift when records are added or removed
+    between two page loads. There is no total count.
+
+    Records with an empty sort field are considered greater than any value
+    (the PostgreSQL default), so they come last in ascending order.
+
+    :param obj: The model object
+    :param domain: The domain of the records
+    :param cursor: The opaque token of the page to display. None displays
+                   the first page.
+    :param per_page: Number of records in a page
+    :param field: The name of the sort field
+    :param direction: ASC or DESC
+    """
+    is_keyset = True
+
+    def __init__(self, obj, domain, cursor=None, per_page=10, field='id',
+            direction='ASC'):
+        self.obj = obj
+        self.domain = domain
+        self.cursor = cursor
+        self.per_page = per_page
+        self.field = field
+        self.direction = direction.upper()
+        self._items = None
+        self.has_prev = False
+        self.has_next = False
+
+    @staticmethod
+    def encode_cursor(mode, value, record_id):
+        """
+        Returns an opaque token for the position of a record
+
+        :param mode: 'n' to fetch the records after, 'p' for the ones before
+        :param value: The value of the sort field of the record
+        :param record_id: The id of the record
+        """
+        if isinstance(value, datetime):
+            value = ['datetime', value.strftime('%Y-%m-%dT%H:%M:%S.%f')]
+        elif isinstance(value, date):
+            value = ['date', value.isoformat()]
+        return urlsafe_b64encode(json.dumps([mode, value, record_id]))
+
+    @staticmethod
+    def decode_cursor(token):
+        """
+        Returns the mode, value and id from a token built by
+        :meth:`encode_cursor`. Invalid tokens return None.
+        """
+        try:
+            mode, value, record_id = json.loads(
+                urlsafe_b64decode(str(token))
+            )
+            if mode not in ('n', 'p'):
+                return None
+            if isinstance(value, list):
+                value_type, value = value
+                if value_type == 'datetime':
+                    value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+                elif value_type == 'date':
+                    value = datetime.strptime(value, '%Y-%m-%d').date()
+                else:
+                    return None
+            elif value is not None and \
+                    not isinstance(value, (basestring, int, long, float)):
+                return None
+            if isinstance(record_id, bool) or \
+                    not isinstance(record_id, (int, long)):
+                return None
+        except (TypeError, ValueError):
+            return None
+        return mode, value, record_id
+
+    def _segments(self, direction):
+        """
+        Returns the (is null, domain) segments of the records in the order
+        they are traversed in the given direction. The records with an
+        empty sort field are searched apart from the others, so their place
+        does not depend on how the database sorts NULL.
+        """
+        not_null = (False, [(self.field, '!=', None)])
+        null = (True, [(self.field, '=', None)])
+        if direction == 'ASC':
+            return [not_null, null]
+        return [null, not_null]
+
+    def _search(self, position, direction, limit):
+        """
+        Returns the ids of the records which come after the position when
+        traversing in the given direction
+
+        :param position: A tuple of the value of the sort field and the id
+                         of a record, or None to start from the first record
+        :param direction: ASC or DESC
+        :param limit: The maximum number of ids
+        """
+        field = self.field
+        operator = '>' if direction == 'ASC' else '<'
+        ids = []
+        for is_null, segment in self._segments(direction):
+            domain = list(self.domain) + segment
+            if position is not None:
+                value, record_id = position
+                if (value is None) != is_null:
+                    # The position is in a later segment
+                    continue
+                if is_null:
+                    domain.append(('id', operator, record_id))
+                else:
+                    domain.append(['OR',
+                        (field, operator, value),
+                        [(field, '=', value), ('id', operator, record_id)],
+                    ])
+                position = None
+            order = [(field, direction), ('id', direction)]
+            if is_null:
+                order = [('id', direction)]
+            ids.extend(self.obj.search(
+                domain, limit=limit - len(ids), order=order
+            ))
+            if len(ids) >= limit:
+                break
+        return ids
+
+    def _load(self):
+        position = self.cursor and self.decode_cursor(self.cursor) or None
+        direction = self.direction
+        if position and position[0] == 'p':
+            # Walk backwards from the first record of the next page
+            direction = 'DESC' if self.direction == 'ASC' else 'ASC'
+
+        ids = self._search(
+            position and position[1:] or None, direction, self.per_page + 1
+        )
+        has_more = len(ids) > self.per_page
+        ids = ids[:self.per_page]
+
+        if position and position[0] == 'p':
+            ids.reverse()
+            self.has_prev, self.has_next = has_more, True
+        else:
+            self.has_prev, self.has_next = bool(position), has_more
+        self._items = self.obj.browse(ids)
+
+    def items(self):
+        """
+        Returns the browse records of the page
+        """
+        if self._items is None:
+            self._load()
+        return self._items
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def __len__(self):
+        return len(self.items())
+
+    def _cursor_for(self, mode, record):
+        return self.encode_cursor(mode, getattr(record, self.field), record.id)
+
+    @property
+    def next_cursor(self):
+        "The token of the next page or None if this is the last page"
+        items = self.items()
+        if not self.has_next or not items:
+            return None
+        return self._cursor_for('n', items[-1])
+
+    @property
+    def prev_cursor(self):
+        "The token of the previous page or None if this is the first page"
+        items = self.items()
+        if not self.has_prev or not items:
+            return None
+        return self._cursor_for('p', items[0])
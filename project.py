@@ -7,23 +7,24 @@
     :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
+import os
 import re
-import tempfile
 import random
 import string
 import json
 import warnings
+import traceback
 import dateutil
 import calendar
-from datetime import datetime, date
+from bisect import bisect_right
+from datetime import datetime, date, timedelta
 from dateutil.relativedelta import relativedelta
-from itertools import groupby, chain, cycle
+from itertools import cycle
 from mimetypes import guess_type
 from email.utils import parseaddr
 
 from nereid import (request, abort, render_template, login_required, url_for,
     redirect, flash, jsonify, render_email, permissions_required)
-from flask import send_file
 from nereid.ctx import has_request_context
 from nereid.signals import registration
 from nereid.contrib.pagination import Pagination
@@ -32,10 +33,45 @@ from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
 from trytond.config import CONFIG
-from trytond.tools import get_smtp_server, datetime_strftime
+from trytond.tools import datetime_strftime, reduce_ids
+from trytond.cache import Cache
+from trytond.backend import TableHandler
+
+from utils import request_cache, bulk_insert, iter_git_log, \
+    conditional_json, rst_to_html, rule_filtered_sql
+from pagination import RankedPagination, KeysetPagination
+from activity import ActivityStream
+from filestore import get_filename, send_stored_file, store_stream, \
+    get_max_size, FileTooLarge
 
 calendar.setfirstweekday(calendar.SUNDAY)
 
+#: Number of previous updates of a task included in its notification emails
+EMAIL_HISTORY_LIMIT = 5
+
+#: A reference to a task in a commit message, like #123
+TASK_REFERENCE_RE = re.compile(r'#(\d+)')
+
+#: Precision in seconds of the last activity of the projects. A work which
+#: was active within this time is not touched again, so the updates of the
+#: tasks of a busy project do not all wait for the lock on its row.
+ACTIVITY_RESOLUTION = 60
+
+#: Number of days the processed repository hook deliveries are kept
+HOOK_RETENTION_DAYS = 7
+
+#: Number of entries of the thread of a task loaded at once
+THREAD_PAGE_SIZE = 25
+
+#: The kinds of dates of the tasks shown on the plan of a project
+PLAN_EVENT_TYPES = ('constraint', 'actual')
+
+#: Fields of project.work whose changes are recorded in the history
+HISTORIZED_FIELDS = (
+    'assigned_to', 'state', 'progress_state', 'constraint_start_time',
+    'constraint_finish_time'
+)
+
 
 class WebSite(ModelSQL, ModelView):
     """
@@ -48,27 +84,48 @@ class WebSite(ModelSQL, ModelView):
         """
         Put recent projects into the home
         """
-        user_obj = Pool().get('nereid.user')
         project_obj = Pool().get('project.work')
 
-        # TODO: Limit to the last 5 projects
-        if user_obj.is_project_admin(request.nereid_user):
-            project_ids = project_obj.search([
-                ('type', '=', 'project'),
-                ('parent', '=', False),
-            ])
-        else:
-            project_ids = project_obj.search([
-                ('participants', '=', request.nereid_user.id),
-                ('type', '=', 'project'),
-                ('parent', '=', False),
-            ])
-        projects = project_obj.browse(project_ids)
+        projects = project_obj.get_recent_projects()
         return render_template('home.jinja', projects=projects)
 
 WebSite()
 
 
+class Attachment(ModelSQL, ModelView):
+    """
+    Attachment
+    """
+    _name = 'ir.attachment'
+
+    #: The nereid user who uploaded the file
+    uploaded_by = fields.Many2One('nereid.user', 'Uploaded By')
+
+    #: Size of the file in bytes, stored when the file is uploaded through
+    #: the file store
+    file_size = fields.Integer('File Size', readonly=True)
+
+    def init(self, module_name):
+        super(Attachment, self).init(module_name)
+        table = TableHandler(Transaction().cursor, self, module_name)
+
+        # The activity stream pages the attachments of the works by date
+        table.index_action(['resource', 'create_date'], 'add')
+
+Attachment()
+
+
+class AttachmentSummary(object):
+    """
+    The metadata of an attachment used for file listings. Unlike the browse
+    record of the attachment this never reads the data of the file.
+    """
+    _name = 'ir.attachment'
+
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
 class ProjectUsers(ModelSQL):
     _name = 'project.work-nereid.user'
     _table = 'project_work_nereid_user_rel'
@@ -81,9 +138,36 @@ class ProjectUsers(ModelSQL):
         'nereid.user', 'User', select=1, required=True
     )
 
+    def create(self, vals):
+        Pool().get('project.work')._all_participant_ids.reset()
+        return super(ProjectUsers, self).create(vals)
+
+    def write(self, ids, vals):
+        Pool().get('project.work')._all_participant_ids.reset()
+        return super(ProjectUsers, self).write(ids, vals)
+
+    def delete(self, ids):
+        Pool().get('project.work')._all_participant_ids.reset()
+        return super(ProjectUsers, self).delete(ids)
+
 ProjectUsers()
 
 
+class ProjectDigestUsers(ModelSQL):
+    _name = 'project.work-nereid.user.digest'
+    _table = 'project_work_digest_nereid_user_rel'
+
+    project = fields.Many2One(
+        'project.work', 'Project',
+        ondelete='CASCADE', select=1, required=True)
+
+    user = fields.Many2One(
+        'nereid.user', 'User', select=1, required=True
+    )
+
+ProjectDigestUsers()
+
+
 class ProjectInvitation(ModelSQL, ModelView):
     "Project Invitation store"
     _name = 'project.work.invitation'
@@ -164,10 +248,9 @@ class ProjectInvitation(ModelSQL, ModelView):
                 from_email=CONFIG['smtp_from'], project=invitation.project,
                 invitation=invitation
             )
-            server = get_smtp_server()
-            server.sendmail(CONFIG['smtp_from'], [invitation.email],
-                email_message.as_string())
-            server.quit()
+            Pool().get('project.work.outbox').queue_mail(
+                CONFIG['smtp_from'], [invitation.email], email_message
+            )
 
             if request.is_xhr:
                 return jsonify({
@@ -220,22 +303,85 @@ class WorkPeriod(ModelSQL, ModelView):
             'periods_overlaps': 'You can not have two overlapping periods!',
         })
 
-    def check_dates(self, ids):
+    def _overlaps(self, ids=None, start_date=None, end_date=None):
+        """
+        Returns True if any of the given periods overlaps another period, or
+        if a period overlaps the range of dates given instead
+
+        :param ids: IDs of the periods to check
+        :param start_date: Start of the range of dates to check
+        :param end_date: End of the range of dates to check
+        """
         cursor = Transaction().cursor
-        for period in self.browse(ids):
-            cursor.execute('SELECT id ' \
-                'FROM "' + self._table + '" ' \
-                'WHERE ((start_date <= %s AND end_date >= %s) ' \
-                        'OR (start_date <= %s AND end_date >= %s) ' \
-                        'OR (start_date >= %s AND end_date <= %s)) ' \
-                    'AND id != %s',
-                (period.start_date, period.start_date,
-                    period.end_date, period.end_date,
-                    period.start_date, period.end_date,
-                    period.id))
+        if ids is None:
+            cursor.execute(
+                'SELECT 1 FROM "' + self._table + '" '
+                'WHERE start_date <= %s AND end_date >= %s '
+                'LIMIT 1', (end_date, start_date)
+            )
+            return bool(cursor.fetchone())
+
+        for i in range(0, len(ids), cursor.IN_MAX):
+            red_sql, red_ids = reduce_ids('a.id', ids[i:i + cursor.IN_MAX])
+            cursor.execute(
+                'SELECT 1 FROM "' + self._table + '" AS a '
+                'JOIN "' + self._table + '" AS b '
+                    'ON b.id != a.id '
+                    'AND b.start_date <= a.end_date '
+                    'AND b.end_date >= a.start_date '
+                'WHERE ' + red_sql + ' LIMIT 1', red_ids
+            )
             if cursor.fetchone():
-                return False
-        return True
+                return True
+        return False
+
+    def check_dates(self, ids):
+        return not self._overlaps(ids)
+
+    def create(self, values):
+        self._get_interval_index.reset()
+        return super(WorkPeriod, self).create(values)
+
+    def write(self, ids, values):
+        self._get_interval_index.reset()
+        return super(WorkPeriod, self).write(ids, values)
+
+    def delete(self, ids):
+        self._get_interval_index.reset()
+        return super(WorkPeriod, self).delete(ids)
+
+    @Cache('project_work_period.interval_index', context=False)
+    def _get_interval_index(self):
+        """
+        Returns the start dates, the end dates and the IDs of the active
+        periods ordered by start date. The periods do not overlap, so the
+        period of a date is found with a binary search on the start dates.
+        """
+        cursor = Transaction().cursor
+        cursor.execute(
+            'SELECT start_date, end_date, id FROM "' + self._table + '" '
+            'WHERE active = %s ORDER BY start_date', (True,)
+        )
+        rows = cursor.fetchall()
+        return (
+            [row[0] for row in rows],
+            [row[1] for row in rows],
+            [row[2] for row in rows],
+        )
+
+    def get_period_for_date(self, date_):
+        """
+        Returns the ID of the active period which contains the date or None
+
+        :param date_: A date or a datetime
+        """
+        if isinstance(date_, datetime):
+            date_ = date_.date()
+        starts, ends, ids = self._get_interval_index()
+        index = bisect_right(starts, date_) - 1
+        if index >= 0 and ends[index] >= date_:
+            return ids[index]
+        return None
 
     @login_required
     def create_work_periods(self):
@@ -251,6 +397,7 @@ class WorkPeriod(ModelSQL, ModelView):
                 request.form.get('start_date'), '%m/%d/%Y')
             end_date = datetime.strptime(
                 request.form.get('end_date'), '%m/%d/%Y')
+            rows = []
             while period_start_date < end_date:
                 period_end_date = period_start_date + \
                     relativedelta(days=7)
@@ -259,12 +406,26 @@ class WorkPeriod(ModelSQL, ModelView):
                 name = datetime_strftime(period_start_date, '%d/%b')
                 if name != datetime_strftime(period_end_date, '%d/%b'):
                     name += ' - ' + datetime_strftime(period_end_date, '%d/%b')
-                self.create({
-                    'name': name,
-                    'start_date': period_start_date,
-                    'end_date': period_end_date,
-                })
+                rows.append((
+                    name, period_start_date.date(), period_end_date.date(),
+                    True
+                ))
                 period_start_date = period_end_date + relativedelta(days=1)
+
+            # The generated periods do not overlap each other, so checking
+            # the whole range once replaces the constraint of each create
+            if rows and self._overlaps(
+                    start_date=start_date.date(), end_date=end_date.date()):
+                flash(self._error_messages['periods_overlaps'])
+                return redirect(request.referrer)
+            bulk_insert(
+                self._table, ['name', 'start_date', 'end_date', 'active'],
+                rows
+            )
+            self._get_interval_index.reset()
+            Pool().get('project.work').assign_work_periods(
+                only_unassigned=True
+            )
             flash("Periods successfully created.")
             return redirect(url_for('project.work.period.render_periods'))
 
@@ -320,6 +481,16 @@ class Project(ModelSQL, ModelView):
 
     created_by = fields.Many2One('nereid.user', 'Created by')
 
+    #: Users who get a digest of the updates of the tasks of the project
+    #: instead of an email for every update
+    digest_subscribers = fields.Many2Many(
+        'project.work-nereid.user.digest', 'project', 'user',
+        'Digest Subscribers', states={
+            'invisible': Eval('type') != 'project',
+            'readonly': Eval('type') != 'project',
+        }
+    )
+
     all_participants = fields.Function(
         fields.Many2Many(
             'project.work-nereid.user', 'project', 'user',
@@ -364,72 +535,358 @@ class Project(ModelSQL, ModelView):
         'project.work.commit', 'project', 'Repo Commits'
     )
 
+    #: Updated whenever the project, its tasks, their history, timesheet
+    #: lines or commits change. Used to order the projects on the home page.
+    last_activity = fields.DateTime(
+        'Last Activity', readonly=True, select=True
+    )
+
     def default_progress_state(self):
         return 'Backlog'
 
+    def default_last_activity(self):
+        return datetime.utcnow()
+
     def __init__(self):
         super(Project, self).__init__()
 
+    def init(self, module_name):
+        super(Project, self).init(module_name)
+        cursor = Transaction().cursor
+
+        # Projects created before the field existed are ordered by their
+        # last modification
+        cursor.execute(
+            'UPDATE "' + self._table + '" '
+            'SET last_activity = COALESCE(write_date, create_date) '
+            'WHERE last_activity IS NULL'
+        )
+
+        # The plan looks up the tasks whose dates overlap a range
+        table = TableHandler(cursor, self, module_name)
+        for event_type in PLAN_EVENT_TYPES:
+            table.index_action([
+                '%s_start_time' % event_type, '%s_finish_time' % event_type
+            ], 'add')
+
+    def assign_work_periods(self, ids=None, only_unassigned=False):
+        """
+        Assigns the tasks to the work period which contains their constraint
+        finish time. The periods are looked up in the cached interval index
+        and every period is set on its tasks with a single update.
+
+        :param ids: IDs of the tasks. All the tasks when None.
+        :param only_unassigned: Leave the tasks which already have a period
+        """
+        period_obj = Pool().get('project.work.period')
+        cursor = Transaction().cursor
+
+        query = 'SELECT id, constraint_finish_time, work_period ' \
+            'FROM "' + self._table + '" ' \
+            'WHERE type = %s AND constraint_finish_time IS NOT NULL'
+        if only_unassigned:
+            query += ' AND work_period IS NULL'
+        if ids is None:
+            cursor.execute(query, ('task',))
+            rows = cursor.fetchall()
+        else:
+            rows = []
+            for i in range(0, len(ids), cursor.IN_MAX):
+                red_sql, red_ids = reduce_ids('id', ids[i:i + cursor.IN_MAX])
+                cursor.execute(query + ' AND ' + red_sql, ['task'] + red_ids)
+                rows.extend(cursor.fetchall())
+
+        tasks_by_period = {}
+        for task_id, finish_time, current_period in rows:
+            period_id = period_obj.get_period_for_date(finish_time)
+            if period_id and period_id != current_period:
+                tasks_by_period.setdefault(period_id, []).append(task_id)
+
+        for period_id, task_ids in tasks_by_period.iteritems():
+            for i in range(0, len(task_ids), cursor.IN_MAX):
+                red_sql, red_ids = reduce_ids(
+                    'id', task_ids[i:i + cursor.IN_MAX]
+                )
+                cursor.execute(
+                    'UPDATE "' + self._table + '" SET work_period = %s '
+                    'WHERE ' + red_sql, [period_id] + red_ids
+                )
+
+    def touch_activity(self, ids, column='id'):
+        """
+        Sets the last activity of the given works and all their parents to
+        now. This is a plain SQL update, so it does not create history or
+        trigger the other side effects of write.
+
+        A work is touched once per request, and works touched within the
+        last ACTIVITY_RESOLUTION seconds are left as they are. Nothing is
+        done with the skip_activity context, which is set by the callers
+        that touch the works themselves once they are done.
+
+        :param ids: IDs of the project works, or of the timesheet works if
+                    column is 'work'
+        :param column: 'id' or 'work'
+        """
+        timesheet_work_obj = Pool().get('timesheet.work')
+        cursor = Transaction().cursor
+
+        assert column in ('id', 'work')
+        if Transaction().context.get('skip_activity'):
+            return
+        touched = request_cache('project_activity')
+        ids = [
+            i for i in set(filter(None, ids)) if (column, i) not in touched
+        ]
+        touched.update(((column, i), True) for i in ids)
+
+        now = datetime.utcnow()
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('w.' + column, sub_ids)
+            cursor.execute(
+                'UPDATE "' + self._table + '" SET last_activity = %s '
+                'WHERE (last_activity IS NULL OR last_activity < %s) '
+                'AND work IN ('
+                    'WITH RECURSIVE chain (work) AS ('
+                        'SELECT w.work FROM "' + self._table + '" AS w '
+                        'WHERE ' + red_sql + ' '
+                        'UNION '
+                        'SELECT tw.parent FROM chain '
+                        'JOIN "' + timesheet_work_obj._table + '" AS tw '
+                            'ON tw.id = chain.work '
+                        'WHERE tw.parent IS NOT NULL'
+                    ') SELECT work FROM chain'
+                ')', [
+                    now, now - timedelta(seconds=ACTIVITY_RESOLUTION)
+                ] + red_ids
+            )
+
+    def get_recent_projects(self, per_page=10):
+        """
+        Returns the top level projects of the current user, most recently
+        active first. The page is selected by the cursor argument of the
+        request, which allows the home pages to load more projects.
+
+        :param per_page: Number of projects in a page
+        """
+        nereid_user_obj = Pool().get('nereid.user')
+
+        domain = [
+            ('type', '=', 'project'),
+            ('parent', '=', False),
+        ]
+        if not nereid_user_obj.is_project_admin(request.nereid_user):
+            domain.append(('participants', '=', request.nereid_user.id))
+        return KeysetPagination(
+            self, domain, request.args.get('cursor'), per_page,
+            field='last_activity', direction='DESC'
+        )
+
     @login_required
     def home(self):
         """
         Put recent projects into the home
         """
-        user_obj = Pool().get('nereid.user')
-        project_obj = Pool().get('project.work')
-
-        # TODO: Limit to the last 5 projects
-        if user_obj.is_project_admin(request.nereid_user):
-            project_ids = project_obj.search([
-                ('type', '=', 'project'),
-                ('parent', '=', False),
-            ])
-        else:
-            project_ids = project_obj.search([
-                ('participants', '=', request.nereid_user.id),
-                ('type', '=', 'project'),
-                ('parent', '=', False),
-            ])
-        projects = project_obj.browse(project_ids)
+        projects = self.get_recent_projects()
         return render_template('project/home.jinja', projects=projects)
 
     def rst_to_html(self):
         """
         Return the response as rst converted to html
         """
-        text = request.form['text']
-        return render_template('project/rst_to_html.jinja', text=text)
+        return rst_to_html(request.form['text'])
+
+    def _attachment_resources(self, ids):
+        """
+        Returns a dictionary mapping the resource string used by
+        ir.attachment to the id of the work
+
+        :param ids: IDs of the works
+        """
+        return dict(('%s,%d' % (self._name, work_id), work_id) \
+            for work_id in ids)
 
     def get_attachments(self, ids, name=None):
         """
         Return all the attachments in the object
         """
         attachment_obj = Pool().get('ir.attachment')
+        cursor = Transaction().cursor
 
-        vals = {}
-        for project_id in ids:
-            attachments = attachment_obj.search([
-                ('resource', '=', '%s,%d' % (self._name, project_id))
-            ])
-            vals[project_id] = attachments
+        resources = self._attachment_resources(ids)
+        vals = dict((work_id, []) for work_id in ids)
+        resource_keys = resources.keys()
+        for i in range(0, len(resource_keys), cursor.IN_MAX):
+            sub_resources = resource_keys[i:i + cursor.IN_MAX]
+            cursor.execute(
+                'SELECT id, resource FROM "' + attachment_obj._table + '" '
+                'WHERE resource IN (' + \
+                    ','.join(('%s',) * len(sub_resources)) + ') '
+                'ORDER BY id', sub_resources
+            )
+            for attachment_id, resource in cursor.fetchall():
+                vals[resources[resource]].append(attachment_id)
+        return vals
+
+    def get_attachment_summaries(self, ids):
+        """
+        Returns a dictionary with a list of :class:`AttachmentSummary` for
+        each of the works. Only the metadata of the attachments is read,
+        the data of the files is never loaded.
+
+        :param ids: IDs of the works
+        """
+        cursor = Transaction().cursor
+
+        resources = self._attachment_resources(ids)
+        rows = []
+        resource_keys = resources.keys()
+        for i in range(0, len(resource_keys), cursor.IN_MAX):
+            sub_resources = resource_keys[i:i + cursor.IN_MAX]
+            rows.extend(self._read_attachment_rows('resource', sub_resources))
+
+        vals = dict((work_id, []) for work_id in ids)
+        for summary in self._summarize_attachments(rows):
+            vals[summary.work].append(summary)
         return vals
 
+    def get_attachment_summaries_by_id(self, attachment_ids):
+        """
+        Returns a dictionary mapping the id of each of the attachments to
+        its :class:`AttachmentSummary`
+
+        :param attachment_ids: IDs of the attachments
+        """
+        cursor = Transaction().cursor
+
+        rows = []
+        for i in range(0, len(attachment_ids), cursor.IN_MAX):
+            sub_ids = attachment_ids[i:i + cursor.IN_MAX]
+            rows.extend(self._read_attachment_rows('id', sub_ids))
+        return dict(
+            (summary.id, summary)
+            for summary in self._summarize_attachments(rows)
+        )
+
+    def _read_attachment_rows(self, column, values):
+        """
+        Returns the metadata rows of the attachments whose column is one
+        of the values, ordered by id. Like search, the attachments hidden
+        by the record rules of the user are left out.
+        """
+        attachment_obj = Pool().get('ir.attachment')
+        rule_obj = Pool().get('ir.rule')
+        cursor = Transaction().cursor
+
+        rule_sql = ''
+        domain1, domain2 = rule_obj.domain_get(attachment_obj._name,
+            mode='read')
+        if domain1:
+            rule_sql = ' AND ' + domain1
+        cursor.execute(
+            'SELECT id, resource, name, type, link, description, '
+                'create_date, uploaded_by, file_size '
+            'FROM "' + attachment_obj._table + '" '
+            'WHERE "' + column + '" IN (' + \
+                ','.join(('%s',) * len(values)) + ')' + rule_sql + ' '
+            'ORDER BY id', list(values) + list(domain2 or [])
+        )
+        return cursor.fetchall()
+
+    def _summarize_attachments(self, rows):
+        """
+        Returns a list of :class:`AttachmentSummary` for the rows read by
+        :meth:`_read_attachment_rows`
+        """
+        attachment_obj = Pool().get('ir.attachment')
+        nereid_user_obj = Pool().get('nereid.user')
+
+        # The size of the files uploaded before it was stored is computed
+        # from the file store
+        sizes = dict(
+            (r['id'], r['data_size']) for r in attachment_obj.read([
+                row[0] for row in rows if row[3] == 'data' and row[8] is None
+            ], ['data_size'])
+        )
+        uploaders = dict(
+            (user.id, user) for user in nereid_user_obj.browse(
+                list(set(row[7] for row in rows if row[7]))
+            )
+        )
+
+        summaries = []
+        for (attachment_id, resource, name, type_, link, description,
+                create_date, uploaded_by, file_size) in rows:
+            summaries.append(AttachmentSummary(
+                id=attachment_id, work=int(resource.split(',')[1]),
+                name=name, type=type_, link=link, description=description,
+                data_size=sizes.get(attachment_id, file_size),
+                create_date=create_date,
+                uploaded_by=uploaders.get(uploaded_by),
+            ))
+        return summaries
+
+    def _fetch_all_participant_ids(self, ids):
+        """
+        Returns a dictionary with the ids of the participants and project
+        admins of each of the given works and all of their parents. The
+        parent chain is walked with one recursive query per IN_MAX ids.
+
+        :param ids: IDs of the works
+        """
+        timesheet_work_obj = Pool().get('timesheet.work')
+        participant_obj = Pool().get('project.work-nereid.user')
+        company_admin_obj = Pool().get('company.company-nereid.user')
+        cursor = Transaction().cursor
+
+        vals = dict((work_id, set()) for work_id in ids)
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('w.id', sub_ids)
+            cursor.execute(
+                'WITH RECURSIVE chain (origin, work) AS ('
+                    'SELECT w.id, w.work FROM "' + self._table + '" AS w '
+                    'WHERE ' + red_sql + ' '
+                    'UNION '
+                    'SELECT chain.origin, tw.parent FROM chain '
+                    'JOIN "' + timesheet_work_obj._table + '" AS tw '
+                        'ON tw.id = chain.work '
+                    'WHERE tw.parent IS NOT NULL'
+                ') '
+                'SELECT chain.origin, m."user" FROM chain '
+                'JOIN "' + self._table + '" AS w ON w.work = chain.work '
+                'JOIN "' + participant_obj._table + '" AS m '
+                    'ON m.project = w.id '
+                'UNION '
+                'SELECT chain.origin, a."user" FROM chain '
+                'JOIN "' + timesheet_work_obj._table + '" AS tw '
+                    'ON tw.id = chain.work '
+                'JOIN "' + company_admin_obj._table + '" AS a '
+                    'ON a.company = tw.company', red_ids
+            )
+            for work_id, user_id in cursor.fetchall():
+                vals[work_id].add(user_id)
+        return dict((k, list(v)) for k, v in vals.iteritems())
+
+    @Cache('project_work.all_participant_ids', context=False)
+    def _all_participant_ids(self, work_id):
+        """
+        Cached participants of a single work. The cache is reset whenever
+        the participants of a project, the project admins or the parent or
+        the company of a timesheet work change.
+
+        :param work_id: ID of the work
+        """
+        return self._fetch_all_participant_ids([work_id])[work_id]
+
     def get_all_participants(self, ids, name=None):
         """
         All participants includes the participants in the project and also
         the admins
         """
-        vals = {}
-        for work in self.browse(ids):
-            vals[work.id] = []
-            vals[work.id].extend([p.id for p in work.participants])
-            vals[work.id].extend([p.id for p in work.company.project_admins])
-            if work.parent:
-                vals[work.id].extend(
-                    [p.id for p in work.parent.all_participants]
-                )
-            vals[work.id] = list(set(vals[work.id]))
-        return vals
+        if len(ids) == 1:
+            return {ids[0]: list(self._all_participant_ids(ids[0]))}
+        return self._fetch_all_participant_ids(ids)
 
     def create(self, values):
         if has_request_context():
@@ -442,20 +899,161 @@ class Project(ModelSQL, ModelView):
         else:
             # TODO: identify the nereid user through employee
             pass
-        return super(Project, self).create(values)
+        work_id = super(Project, self).create(values)
+        if values.get('type') == 'task':
+            Pool().get('project.work.search').update_index([work_id])
+            if values.get('constraint_finish_time') and \
+                    not values.get('work_period'):
+                self.assign_work_periods([work_id])
+        self.touch_activity([work_id])
+        return work_id
+
+    def _fetch_authorized(self, work_id, work_type, user):
+        """
+        Fetches the work of the given type and checks in the same query if
+        the user is a project admin or a participant of the project (the
+        parent project in case of tasks). Both the results are memoized for
+        the rest of the request. Like search, the record rules of the
+        Tryton user apply to the work.
+
+        Returns the id of the project against which the permissions were
+        checked, or None if the work does not exist or is not readable.
+
+        :param work_id: ID of the project or task
+        :param work_type: 'project' or 'task'
+        :param user: The browse record of the nereid user
+        """
+        timesheet_work_obj = Pool().get('timesheet.work')
+        participant_obj = Pool().get('project.work-nereid.user')
+        company_admin_obj = Pool().get('company.company-nereid.user')
+        cursor = Transaction().cursor
 
-    def can_read(self, project, user):
+        if work_type == 'task':
+            # The permissions of a task are those of its parent project
+            project_join = 'JOIN "' + self._table + '" AS p ' \
+                'ON p.work = tw.parent '
+        else:
+            project_join = 'JOIN "' + self._table + '" AS p ' \
+                'ON p.id = w.id '
+
+        rule_sql = ''
+        from_, where, rule_args = rule_filtered_sql(self._name, [])
+        if where:
+            rule_sql = ' AND w.id IN (SELECT "' + self._table + '".id' + \
+                from_ + where + ')'
+
+        cursor.execute(
+            'SELECT p.id, '
+                'EXISTS (SELECT a.id FROM "' + company_admin_obj._table + \
+                    '" AS a WHERE a.company = %s AND a."user" = %s), '
+                'EXISTS (SELECT m.id FROM "' + participant_obj._table + \
+                    '" AS m WHERE m.project = p.id AND m."user" = %s) '
+            'FROM "' + self._table + '" AS w '
+            'JOIN "' + timesheet_work_obj._table + '" AS tw '
+                'ON tw.id = w.work ' + project_join +
+            'WHERE w.id = %s AND w.type = %s AND tw.active = %s' + rule_sql,
+            [
+                request.nereid_website.company.id, user.id, user.id,
+                work_id, work_type, True
+            ] + rule_args
+        )
+        row = cursor.fetchone()
+        if not row:
+            return None
+
+        project_id, is_admin, is_participant = row
+        request_cache('project_admin')[user.id] = bool(is_admin)
+        request_cache('project_participant')[(project_id, user.id)] = \
+            bool(is_participant)
+        return project_id
+
+    def is_participant(self, project_id, user):
         """
-        Returns true if the given nereid user can read the project
+        Returns True if the user is a project admin or a participant of the
+        given project. The membership is memoized for the rest of the
+        request.
 
-        :param project: The browse record of the project
-        :param user: The browse record of the current nereid user
+        :param project_id: ID of the project
+        :param user: The browse record of the nereid user
         """
         nereid_user_obj = Pool().get('nereid.user')
+        participant_obj = Pool().get('project.work-nereid.user')
 
         if nereid_user_obj.is_project_admin(user):
             return True
-        if not user in project.participants:
+
+        cache = request_cache('project_participant')
+        if (project_id, user.id) not in cache:
+            cursor = Transaction().cursor
+            cursor.execute(
+                'SELECT id FROM "' + participant_obj._table + '" '
+                'WHERE project = %s AND "user" = %s', (project_id, user.id)
+            )
+            cache[(project_id, user.id)] = bool(cursor.fetchone())
+        return cache[(project_id, user.id)]
+
+    def get_digest_subscriber_ids(self, project_id):
+        """
+        Returns the set of the IDs of the users who opted in for the digest
+        of the project. This is memoized for the rest of the request.
+
+        :param project_id: ID of the project
+        """
+        digest_user_obj = Pool().get('project.work-nereid.user.digest')
+
+        cache = request_cache('project_digest')
+        if project_id not in cache:
+            cursor = Transaction().cursor
+            cursor.execute(
+                'SELECT "user" FROM "' + digest_user_obj._table + '" '
+                'WHERE project = %s', (project_id,)
+            )
+            cache[project_id] = set(row[0] for row in cursor.fetchall())
+        return cache[project_id]
+
+    @login_required
+    def toggle_digest(self, project_id):
+        """
+        Switches the current user between an email for every update of the
+        tasks of the project and a digest of the updates
+
+        :param project_id: ID of the project
+        """
+        digest_user_obj = Pool().get('project.work-nereid.user.digest')
+
+        project = self.get_project(project_id)
+
+        ids = digest_user_obj.search([
+            ('project', '=', project.id),
+            ('user', '=', request.nereid_user.id),
+        ])
+        if ids:
+            digest_user_obj.delete(ids)
+            message = "You will get an email for every update of %s"
+        else:
+            digest_user_obj.create({
+                'project': project.id,
+                'user': request.nereid_user.id,
+            })
+            message = "You will get a digest of the updates of %s"
+        request_cache('project_digest').pop(project.id, None)
+
+        if request.is_xhr:
+            return jsonify({
+                'success': True,
+                'digest': not ids,
+            })
+        flash(message % project.name)
+        return redirect(request.referrer)
+
+    def can_read(self, project, user):
+        """
+        Returns true if the given nereid user can read the project
+
+        :param project: The browse record of the project
+        :param user: The browse record of the current nereid user
+        """
+        if not self.is_participant(project.id, user):
             raise abort(404)
         return True
 
@@ -466,11 +1064,7 @@ class Project(ModelSQL, ModelView):
         :param project: The browse record of the project
         :param user: The browse record of the current nereid user
         """
-        nereid_user_obj = Pool().get('nereid.user')
-
-        if nereid_user_obj.is_project_admin(user):
-            return True
-        if not user in project.participants:
+        if not self.is_participant(project.id, user):
             raise abort(404)
         return True
 
@@ -481,21 +1075,15 @@ class Project(ModelSQL, ModelView):
 
         :param project_id: ID of the project
         """
-        project = self.search([
-            ('id', '=', project_id),
-            ('type', '=', 'project'),
-        ])
-
-        if not project:
+        if not self._fetch_authorized(
+                project_id, 'project', request.nereid_user):
             raise abort(404)
 
-        project = self.browse(project[0])
-
-        if not self.can_read(project, request.nereid_user):
+        if not self.is_participant(project_id, request.nereid_user):
             # If the user is not allowed to access this project then dont let
             raise abort(404)
 
-        return project
+        return self.browse(project_id)
 
     def get_task(self, task_id):
         """
@@ -504,21 +1092,44 @@ class Project(ModelSQL, ModelView):
 
         :param task_id: ID of the task
         """
-        task = self.search([
-            ('id', '=', task_id),
-            ('type', '=', 'task'),
-        ])
-
-        if not task:
+        project_id = self._fetch_authorized(
+            task_id, 'task', request.nereid_user
+        )
+        if not project_id:
             raise abort(404)
 
-        task = self.browse(task[0])
-
-        if not self.can_write(task.parent, request.nereid_user):
+        if not self.is_participant(project_id, request.nereid_user):
             # If the user is not allowed to access this project then dont let
             raise abort(403)
 
-        return task
+        return self.browse(task_id)
+
+    def get_tasks_by_work(self, work_ids):
+        """
+        Returns a dictionary of the timesheet work id and the browse record
+        of the task which owns it, resolved with one query
+
+        :param work_ids: IDs of the timesheet works
+        """
+        cursor = Transaction().cursor
+
+        work_ids = list(set(work_ids))
+        task_by_work = {}
+        for i in range(0, len(work_ids), cursor.IN_MAX):
+            sub_ids = work_ids[i:i + cursor.IN_MAX]
+            red_sql, red_ids = reduce_ids('work', sub_ids)
+            cursor.execute(
+                'SELECT work, id FROM "' + self._table + '" '
+                'WHERE ' + red_sql, red_ids
+            )
+            task_by_work.update(cursor.fetchall())
+        tasks = dict(
+            (task.id, task) for task in self.browse(task_by_work.values())
+        )
+        return dict(
+            (work_id, tasks[task_id]) \
+                for work_id, task_id in task_by_work.iteritems()
+        )
 
     def get_tasks_by_tag(self, tag_id):
         """Return the tasks associated with a tag
@@ -530,14 +1141,57 @@ class Project(ModelSQL, ModelView):
         ])
         return tasks
 
+    def get_activity_stream(self, project, cursor=None, per_page=20):
+        """
+        Returns the activity of the project and of all its tasks, newest
+        first, paginated with a cursor
+
+        :param project: Browse record of the project
+        :param cursor: The cursor of the page
+        :param per_page: Number of entries in a page
+        """
+        timesheet_work_obj = Pool().get('timesheet.work')
+        return ActivityStream(
+            'SELECT w.id FROM "' + self._table + '" AS w '
+            'JOIN "' + timesheet_work_obj._table + '" AS tw '
+                'ON tw.id = w.work '
+            'WHERE tw.parent = %s OR w.id = %s',
+            [project.work.id, project.id], cursor=cursor, per_page=per_page
+        )
+
     @login_required
     def render_project(self, project_id):
         """
-        Renders a project
+        Renders a project with its recent activity
+        """
+        project = self.get_project(project_id)
+        return render_template(
+            'project/project.jinja', project=project, active_type_name="recent",
+            activity=self.get_activity_stream(project)
+        )
+
+    @login_required
+    def render_activity(self, project_id):
+        """
+        Renders the activity of a project and its tasks, newest first. The
+        cursor argument selects the page. XHR requests get the rendered
+        entries to append to the page.
         """
         project = self.get_project(project_id)
+        activity = self.get_activity_stream(
+            project, request.args.get('cursor', None)
+        )
+        if request.is_xhr:
+            return jsonify({
+                'html': unicode(render_template(
+                    'project/activity-entries.jinja', activity=activity,
+                    project=project
+                )),
+                'next_cursor': activity.next_cursor,
+            })
         return render_template(
-            'project/project.jinja', project=project, active_type_name="recent"
+            'project/project.jinja', project=project,
+            active_type_name="recent", activity=activity
         )
 
     @login_required
@@ -644,6 +1298,8 @@ class Project(ModelSQL, ModelView):
         :param task_id: ID of task
         :param receivers: Receivers of email.
         """
+        nereid_user_obj = Pool().get('nereid.user')
+
         task = self.browse(task_id)
 
         subject = "[#%s %s] - %s" % (
@@ -656,6 +1312,17 @@ class Project(ModelSQL, ModelView):
         if task.created_by.email in receivers:
             receivers.remove(task.created_by.email)
 
+        # Users who opted in for a digest get the task in the next one
+        digest_ids = self.get_digest_subscriber_ids(task.parent.id)
+        if digest_ids:
+            digest_users = [
+                u for u in nereid_user_obj.browse(list(digest_ids))
+                if u.email in receivers
+            ]
+            Pool().get('project.work.notification').defer(task, digest_users)
+            digest_emails = set(u.email for u in digest_users)
+            receivers = [r for r in receivers if r not in digest_emails]
+
         if not receivers:
             return
 
@@ -669,11 +1336,9 @@ class Project(ModelSQL, ModelView):
             updated_by=request.nereid_user.name
         )
 
-        #Send mail.
-        server = get_smtp_server()
-        server.sendmail(CONFIG['smtp_from'], receivers,
-            message.as_string())
-        server.quit()
+        Pool().get('project.work.outbox').queue_mail(
+            CONFIG['smtp_from'], receivers, message
+        )
 
     @login_required
     def unwatch(self, task_id):
@@ -798,10 +1463,9 @@ class Project(ModelSQL, ModelView):
             )
             flash_message = "%s has been invited to the project" % email
 
-        server = get_smtp_server()
-        server.sendmail(CONFIG['smtp_from'], [email],
-            email_message.as_string())
-        server.quit()
+        Pool().get('project.work.outbox').queue_mail(
+            CONFIG['smtp_from'], [email], email_message
+        )
 
         if request.is_xhr:
             return jsonify({
@@ -849,12 +1513,68 @@ class Project(ModelSQL, ModelView):
         flash("Could not remove participant! Try again.")
         return redirect(request.referrer)
 
+    def get_task_facets(self, domain):
+        """
+        Returns the number of tasks matching the domain by state, by tag and
+        by assignee. All the counts are computed with a single query.
+
+        :param domain: The filter domain of the task list
+        :return: A dictionary with the keys 'state', 'tags' and
+                 'assigned_to', each being a dictionary of the value and the
+                 number of tasks
+        """
+        tag_rel_obj = Pool().get('project.work-project.work.tag')
+        cursor = Transaction().cursor
+
+        from_, where, args = rule_filtered_sql(self._name, domain)
+        # The matched tasks are selected once and grouped three times
+        cursor.execute(
+            'WITH f AS ('
+                'SELECT "%s".id AS id, "%s".state AS state, '
+                '"%s".assigned_to AS assigned_to' % ((self._table,) * 3) + \
+                from_ + where +
+            ') '
+            "SELECT 'state', CAST(f.state AS VARCHAR), COUNT(f.id) "
+            'FROM f GROUP BY f.state '
+            'UNION ALL '
+            "SELECT 'assigned_to', CAST(f.assigned_to AS VARCHAR), "
+                'COUNT(f.id) '
+            'FROM f GROUP BY f.assigned_to '
+            'UNION ALL '
+            "SELECT 'tags', CAST(r.tag AS VARCHAR), COUNT(f.id) "
+            'FROM f '
+            'JOIN "' + tag_rel_obj._table + '" AS r ON r.task = f.id '
+            'GROUP BY r.tag', args
+        )
+
+        facets = {'state': {}, 'tags': {}, 'assigned_to': {}}
+        for facet, value, count in cursor.fetchall():
+            if facet != 'state':
+                value = value and int(value) or None
+            facets[facet][value] = count
+        return facets
+
+    def get_task_counts(self, domain):
+        """
+        Returns the counts shown on the task lists for the domain
+
+        :param domain: The filter domain of the task list
+        """
+        facets = self.get_task_facets(domain)
+        return {
+            'opened_tasks_count': facets['state'].get('opened', 0),
+            'done_tasks_count': facets['state'].get('done', 0),
+            'all_tasks_count': sum(facets['state'].values()),
+            'tags': facets['tags'],
+            'assigned_to': facets['assigned_to'],
+        }
+
     @login_required
     def render_task_list(self, project_id):
         """
         Renders a project's task list page
         """
-        tag_task_obj = Pool().get('project.work-project.work.tag')
+        task_search_obj = Pool().get('project.work.search')
         project = self.get_project(project_id)
         state = request.args.get('state', None)
         page = request.args.get('page', 1, int)
@@ -864,13 +1584,6 @@ class Project(ModelSQL, ModelView):
             ('parent', '=', project.id),
         ]
 
-        query = request.args.get('q', None)
-        if query:
-            # This search is probably the suckiest search in the
-            # history of mankind in terms of scalability and utility
-            # TODO: Figure out something better
-            filter_domain.append(('name', 'ilike', '%%%s%%' % query))
-
         tag = request.args.get('tag', None, int)
         if tag:
             filter_domain.append(('tags', '=', tag))
@@ -879,24 +1592,44 @@ class Project(ModelSQL, ModelView):
         if user:
             filter_domain.append(('assigned_to', '=', user))
 
-        counts = {}
-        counts['opened_tasks_count'] = self.search(
-            filter_domain + [('state', '=', 'opened')], count=True
-        )
-        counts['done_tasks_count'] = self.search(
-            filter_domain + [('state', '=', 'done')], count=True
-        )
-        counts['all_tasks_count'] = self.search(
-            filter_domain, count=True
-        )
+        query = request.args.get('q', None)
+        ranked_ids = None
+        if query:
+            # Only the tasks of the list are ranked
+            ranked_ids = task_search_obj.search_tasks(query, filter_domain)
+            filter_domain.append(('id', 'in', ranked_ids))
+
+        counts = self.get_task_counts(filter_domain)
 
         if state and state in ('opened', 'done'):
             filter_domain.append(('state', '=', state))
-        tasks = Pagination(self, filter_domain, page, 10)
+        if ranked_ids is not None:
+            tasks = RankedPagination(self, filter_domain, ranked_ids, page, 10)
+        elif 'page' in request.args:
+            # Links to numbered pages keep working
+            tasks = Pagination(self, filter_domain, page, 10)
+        else:
+            tasks = KeysetPagination(
+                self, filter_domain, request.args.get('cursor'), 10,
+                field='create_date', direction='DESC'
+            )
         return render_template(
             'project/task-list.jinja', project=project,
             active_type_name='render_task_list', counts=counts,
-            state_filter=state, tasks=tasks
+            state_filter=state, tasks=tasks,
+            list_args=self._get_list_args(state, query, tag, user)
+        )
+
+    def _get_list_args(self, state=None, query=None, tag=None, user=None):
+        """
+        Returns the filters of a task list which are active, as arguments
+        of the URL of the list. The pagination links forward them so the
+        next page is a page of the same list.
+        """
+        return dict(
+            (name, value) for name, value in (
+                ('state', state), ('q', query), ('tag', tag), ('user', user),
+            ) if value
         )
 
     @login_required
@@ -904,7 +1637,7 @@ class Project(ModelSQL, ModelView):
         """
         Renders all tasks of the user in all projects
         """
-        tag_task_obj = Pool().get('project.work-project.work.tag')
+        task_search_obj = Pool().get('project.work.search')
         state = request.args.get('state', None)
         page = request.args.get('page', 1, int)
 
@@ -913,37 +1646,39 @@ class Project(ModelSQL, ModelView):
             ('assigned_to', '=', request.nereid_user.id)
         ]
 
-        query = request.args.get('q', None)
-        if query:
-            # This search is probably the suckiest search in the
-            # history of mankind in terms of scalability and utility
-            # TODO: Figure out something better
-            filter_domain.append(('name', 'ilike', '%%%s%%' % query))
-
         tag = request.args.get('tag', None, int)
         if tag:
             filter_domain.append(('tags', '=', tag))
 
-        counts = {}
-        counts['opened_tasks_count'] = self.search(
-            filter_domain + [('state', '=', 'opened')], count=True
-        )
-        counts['done_tasks_count'] = self.search(
-            filter_domain + [('state', '=', 'done')], count=True
-        )
-        counts['all_tasks_count'] = self.search(
-            filter_domain, count=True
-        )
+        query = request.args.get('q', None)
+        ranked_ids = None
+        if query:
+            # Only the tasks of the list are ranked
+            ranked_ids = task_search_obj.search_tasks(query, filter_domain)
+            filter_domain.append(('id', 'in', ranked_ids))
+
+        counts = self.get_task_counts(filter_domain)
 
         if state and state in ('opened', 'done'):
             filter_domain.append(('state', '=', state))
-        tasks = Pagination(
-            self, filter_domain, page, 10, order=[('constraint_finish_time', 'asc')]
-        )
+        if ranked_ids is not None:
+            tasks = RankedPagination(self, filter_domain, ranked_ids, page, 10)
+        elif 'page' in request.args:
+            # Links to numbered pages keep working
+            tasks = Pagination(
+                self, filter_domain, page, 10,
+                order=[('constraint_finish_time', 'asc')]
+            )
+        else:
+            tasks = KeysetPagination(
+                self, filter_domain, request.args.get('cursor'), 10,
+                field='constraint_finish_time', direction='ASC'
+            )
         return render_template(
             'project/global-task-list.jinja',
             active_type_name='render_task_list', counts=counts,
-            state_filter=state, tasks=tasks
+            state_filter=state, tasks=tasks,
+            list_args=self._get_list_args(state, query, tag)
         )
 
     @login_required
@@ -953,31 +1688,80 @@ class Project(ModelSQL, ModelView):
         """
         task = self.get_task(task_id)
 
-        comments = sorted(
-            task.history + task.timesheet_lines + task.attachments + task.repo_commits,
-            key=lambda x: x.create_date
+        attachments = self.get_attachment_summaries([task.id])[task.id]
+
+        return render_template(
+            'project/task.jinja', task=task, active_type_name='render_task_list',
+            project=task.parent, thread=self.get_task_thread(task),
+            attachments=attachments,
+            timesheet_summary=self.get_hours_by_employee(task)
         )
 
-        timesheet_rows = sorted(
-            task.timesheet_lines, key=lambda x: x.employee
+    def get_task_thread(self, task, cursor=None):
+        """
+        Returns the comments, timesheet lines, attachments and commits of
+        the task, newest first, paginated with a cursor
+
+        :param task: Browse record of the task
+        :param cursor: The cursor of the page
+        """
+        return ActivityStream(
+            'SELECT id FROM "' + self._table + '" WHERE id = %s', [task.id],
+            cursor=cursor, per_page=THREAD_PAGE_SIZE
         )
-        timesheet_summary = groupby(timesheet_rows, key=lambda x: x.employee)
 
-        return render_template(
-            'project/task.jinja', task=task, active_type_name='render_task_list',
-            project=task.parent, comments=comments,
-            timesheet_summary=timesheet_summary
+    @login_required
+    def render_task_thread(self, task_id):
+        """
+        Returns the rendered page of the thread of the task older than the
+        cursor argument, and the cursor of the next older page
+        """
+        task = self.get_task(task_id)
+        thread = self.get_task_thread(task, request.args.get('cursor', None))
+        return jsonify({
+            'html': unicode(render_template(
+                'project/thread-entries.jinja', thread=thread, task=task
+            )),
+            'next_cursor': thread.next_cursor,
+        })
+
+    def get_hours_by_employee(self, task):
+        """
+        Returns a list of the employees who worked on the task with the
+        hours they spent, ordered by employee
+
+        :param task: Browse record of the task
+        """
+        timesheet_line_obj = Pool().get('timesheet.line')
+        employee_obj = Pool().get('company.employee')
+        cursor = Transaction().cursor
+
+        cursor.execute(
+            'SELECT employee, SUM(hours) '
+            'FROM "' + timesheet_line_obj._table + '" '
+            'WHERE work = %s GROUP BY employee ORDER BY employee',
+            (task.work.id,)
         )
+        rows = cursor.fetchall()
+        employees = dict(
+            (e.id, e) for e in employee_obj.browse([row[0] for row in rows])
+        )
+        return [(employees[row[0]], row[1]) for row in rows]
 
     @login_required
     def render_files(self, project_id):
         project = self.get_project(project_id)
-        other_attachments = chain.from_iterable(
-            [list(task.attachments) for task in project.children if task.attachments]
+        tasks = project.children
+        summaries = self.get_attachment_summaries(
+            [project.id] + [task.id for task in tasks]
         )
+        other_attachments = [
+            (task, summaries[task.id]) for task in tasks if summaries[task.id]
+        ]
         return render_template(
             'project/files.jinja', project=project, active_type_name='files',
-            guess_type=guess_type, other_attachments=other_attachments
+            guess_type=guess_type, attachments=summaries[project.id],
+            other_attachments=other_attachments
         )
 
     def _get_expected_date_range(self):
@@ -1011,45 +1795,213 @@ class Project(ModelSQL, ModelView):
             day_week_map
         )
 
-    def get_calendar_data(self, domain=None):
+    def _get_timesheet_hours(self, domain, start, day_week_map=None):
+        """
+        Returns the hours of the timesheet lines matching the domain summed
+        by the database by (date, employee) and, if a day to week map is
+        given, by (week, employee).
+
+        :param domain: Domain of the timesheet lines
+        :param start: The first date of the range
+        :param day_week_map: Dictionary of the day of the month and the
+                             week number
+        :return: A tuple of two lists of (date or week, employee id, hours)
+        """
+        timesheet_obj = Pool().get('timesheet.line')
+        cursor = Transaction().cursor
+
+        from_, where, args = rule_filtered_sql(timesheet_obj._name, domain)
+        from_where = from_ + where
+        line = '"%s".' % timesheet_obj._table
+
+        cursor.execute(
+            'SELECT ' + line + 'date, ' + line + 'employee, ' + \
+                'SUM(' + line + 'hours)' + from_where + ' '
+            'GROUP BY ' + line + 'date, ' + line + 'employee '
+            'ORDER BY ' + line + 'date, ' + line + 'employee', args
+        )
+        by_date = cursor.fetchall()
+
+        by_week = []
+        if day_week_map:
+            # Bucket the dates into the weeks of the month with a CASE
+            # on the date ranges of the weeks
+            weeks = {}
+            for day, week in day_week_map.iteritems():
+                if day:
+                    weeks.setdefault(week, []).append(day)
+            if by_date:
+                week_case, week_args = [], []
+                for week, days in sorted(weeks.iteritems()):
+                    week_case.append('WHEN ' + line + 'date BETWEEN %s AND %s '
+                        'THEN %s')
+                    week_args.extend([
+                        start.replace(day=min(days)),
+                        start.replace(day=max(days)), week
+                    ])
+                cursor.execute(
+                    'SELECT CASE ' + ' '.join(week_case) + ' END AS week, ' + \
+                        line + 'employee, SUM(' + line + 'hours)' + \
+                        from_where + ' '
+                    'GROUP BY 1, ' + line + 'employee', week_args + args
+                )
+                by_week = cursor.fetchall()
+        return by_date, by_week
+
+    def get_calendar_data(self, domain=None):
+        """
+        Returns the calendar data
+
+        :param domain: List of tuple to add to the domain expression
+        """
+        start, end, day_week_map = self._get_expected_date_range()
+
+        if domain is None:
+            domain = []
+        domain += [
+            ('date', '>=', start),
+            ('date', '<=', end),
+        ]
+        if request.args.get('employee', None) and \
+                request.nereid_user.has_permissions(request.nereid_user, ['project.admin']):
+            domain.append(
+                ('employee', '=', request.args.get('employee', None, int))
+            )
+        return conditional_json(
+            ('calendar', request.path, start, end,
+                request.args.get('employee', None), self._get_scope()),
+            self._get_timesheet_change_marker(domain),
+            lambda: self._compute_calendar_data(
+                domain, start, day_week_map
+            )
+        )
+
+    def _get_scope(self):
+        """
+        Returns what the JSON responses of the current user depend on
+        besides the arguments of the request: whether the user is a project
+        admin and the language
+        """
+        nereid_user_obj = Pool().get('nereid.user')
+        return (
+            nereid_user_obj.is_project_admin(request.nereid_user),
+            Transaction().language,
+        )
+
+    def _get_change_marker(self, model, domain):
+        """
+        Returns the last write date, the last create date and the number of
+        the records matching the domain. Any change of these records, or
+        their deletion, changes the result.
+
+        :param model: Name of the model
+        :param domain: The domain of the records
+        """
+        model_obj = Pool().get(model)
+        cursor = Transaction().cursor
+
+        from_, where, args = rule_filtered_sql(model, domain)
+        cursor.execute(
+            'SELECT MAX("%s".write_date), MAX("%s".create_date), '
+                'COUNT("%s".id)' % ((model_obj._table,) * 3) + from_ + where,
+            args
+        )
+        return cursor.fetchone()
+
+    def _get_timesheet_hours_by_work(self, domain):
+        """
+        Returns the hours of the timesheet lines matching the domain summed
+        by the database by (date, employee, work), ordered by date and
+        employee
+
+        :param domain: Domain of the timesheet lines
+        :return: A list of (first line id, date, employee id, work id, hours)
+        """
+        timesheet_obj = Pool().get('timesheet.line')
+        cursor = Transaction().cursor
+
+        from_, where, args = rule_filtered_sql(timesheet_obj._name, domain)
+        line = '"%s".' % timesheet_obj._table
+        cursor.execute(
+            'SELECT MIN(' + line + 'id), ' + line + 'date, ' + \
+                line + 'employee, ' + line + 'work, ' + \
+                'SUM(' + line + 'hours)' + from_ + where + ' '
+            'GROUP BY ' + line + 'date, ' + line + 'employee, ' + \
+                line + 'work '
+            'ORDER BY ' + line + 'date, ' + line + 'employee, ' + \
+                line + 'work', args
+        )
+        return cursor.fetchall()
+
+    def _get_timesheet_change_marker(self, domain):
+        """
+        Returns the change marker of the timesheet lines matching the
+        domain, like :meth:`_get_change_marker`, followed by the last write
+        date of their timesheet works and of their employees and parties.
+        The calendar data embeds the names and the URLs of the tasks and
+        the names of the employees, which change with these records.
+
+        :param domain: The domain of the timesheet lines
+        """
+        pool = Pool()
+        timesheet_obj = pool.get('timesheet.line')
+        timesheet_work_obj = pool.get('timesheet.work')
+        employee_obj = pool.get('company.employee')
+        party_obj = pool.get('party.party')
+        cursor = Transaction().cursor
+
+        from_, where, args = rule_filtered_sql(timesheet_obj._name, domain)
+        line = '"%s".' % timesheet_obj._table
+        cursor.execute(
+            'WITH l AS ('
+                'SELECT ' + line + 'id AS id, ' + line + 'work AS work, ' + \
+                line + 'employee AS employee, ' + \
+                line + 'write_date AS write_date, ' + \
+                line + 'create_date AS create_date' + from_ + where +
+            ') '
+            'SELECT (SELECT MAX(write_date) FROM l), '
+                '(SELECT MAX(create_date) FROM l), '
+                '(SELECT COUNT(id) FROM l), '
+                '(SELECT MAX(tw.write_date) '
+                    'FROM "' + timesheet_work_obj._table + '" AS tw '
+                    'WHERE tw.id IN (SELECT work FROM l)), '
+                '(SELECT MAX(e.write_date) '
+                    'FROM "' + employee_obj._table + '" AS e '
+                    'WHERE e.id IN (SELECT employee FROM l)), '
+                '(SELECT MAX(p.write_date) '
+                    'FROM "' + party_obj._table + '" AS p '
+                    'JOIN "' + employee_obj._table + '" AS e '
+                        'ON e.party = p.id '
+                    'WHERE e.id IN (SELECT employee FROM l))', args
+        )
+        return cursor.fetchone()
+
+    def _compute_calendar_data(self, domain, start, day_week_map):
         """
-        Returns the calendar data
+        Computes the calendar data of the timesheet lines matching the
+        domain
 
-        :param domain: List of tuple to add to the domain expression
+        :param domain: The domain of the timesheet lines
+        :param start: The first date of the calendar
+        :param day_week_map: The week of each day of the calendar
         """
-        timesheet_obj = Pool().get('timesheet.line')
-
-        start, end, day_week_map = self._get_expected_date_range()
+        employee_obj = Pool().get('company.employee')
 
-        if domain is None:
-            domain = []
-        domain += [
-            ('date', '>=', start),
-            ('date', '<=', end),
-        ]
-        if request.args.get('employee', None) and \
-                request.nereid_user.has_permissions(request.nereid_user, ['project.admin']):
-            domain.append(
-                ('employee', '=', request.args.get('employee', None, int))
+        by_date, by_week = self._get_timesheet_hours(
+            domain, start, day_week_map
+        )
+        employees = dict(
+            (employee.id, employee) for employee in employee_obj.browse(
+                list(set(row[1] for row in by_date))
             )
-        line_ids = timesheet_obj.search(
-            domain, order=[('date', 'asc'), ('employee', 'asc')]
         )
 
-        # Build an iterable 
-        lines = timesheet_obj.browse(line_ids)
-
         data = {}
+        for date, employee_id, hours in by_date:
+            data.setdefault(date, {})[employees[employee_id]] = hours
         data_by_week = {}
-        for date, g_by_date in groupby(lines, key=lambda line: line.date):
-            for k, g in groupby(g_by_date, key=lambda line: line.employee):
-                data.setdefault(date, {})[k] = sum(
-                    [line.hours for line in g]
-                )
-                if day_week_map:
-                    week = day_week_map[date.day]
-                    data_by_week.setdefault(week, {}).setdefault(line.employee, 0)
-                    data_by_week[week][line.employee] += line.hours
+        for week, employee_id, hours in by_week:
+            data_by_week.setdefault(week, {})[employees[employee_id]] = hours
 
         day_totals=[]
         color_map = {}
@@ -1069,17 +2021,22 @@ class Project(ModelSQL, ModelView):
                     'color': color_map.setdefault(employee, colors.next()),
                 })
 
-        def get_task_from_work(work):
-            task_id, = self.search([('work', '=', work.id)])
-            return self.browse(task_id)
+        # The lines of an employee on a task are summed by day, and all of
+        # them are rendered in a single pass of the template. The theme
+        # appends every item of lines, so the single fragment displays
+        # like one fragment per line.
+        by_work = self._get_timesheet_hours_by_work(domain)
+        tasks_by_work = self.get_tasks_by_work([row[3] for row in by_work])
+        lines = [unicode(render_template(
+            'project/timesheet-lines.jinja', lines=[{
+                'id': line_id,
+                'date': date,
+                'employee': employees[employee_id],
+                'hours': hours,
+                'related_task': tasks_by_work.get(work_id),
+            } for line_id, date, employee_id, work_id, hours in by_work]
+        ))]
 
-        lines = [
-            render_template(
-                    'project/timesheet-line.jinja', line=line,
-                    related_task=get_task_from_work(line.work)
-                ) \
-                for line in timesheet_obj.browse(line_ids)
-        ]
         total_by_employee = {}
         for emp_hours_map in data_by_week.values():
             for employee, hours in emp_hours_map.iteritems():
@@ -1090,7 +2047,9 @@ class Project(ModelSQL, ModelView):
             'project/work-week.jinja', data_by_week=data_by_week,
             total_by_employee=total_by_employee
         )
-        return jsonify(day_totals=day_totals, lines=lines, work_week=work_week)
+        return jsonify(
+            day_totals=day_totals, lines=lines, work_week=work_week
+        )
 
     @login_required
     @permissions_required(['project.admin'])
@@ -1121,6 +2080,65 @@ class Project(ModelSQL, ModelView):
             active_type_name="timesheet", employees=employees
         )
 
+    def get_plan_events(self, project, event_type, start, end):
+        """
+        Returns the calendar events of the tasks of the project whose
+        planned or actual dates overlap the range. Tasks without a finish
+        time are events on their start time. Only the columns needed for the
+        events are read.
+
+        :param project: Browse record of the project
+        :param event_type: 'constraint' or 'actual'
+        :param start: Start of the range as a datetime
+        :param end: End of the range as a datetime
+        """
+        timesheet_work_obj = Pool().get('timesheet.work')
+        cursor = Transaction().cursor
+
+        start_field = '%s_start_time' % event_type
+        finish_field = '%s_finish_time' % event_type
+        from_, where, args = rule_filtered_sql(self._name, [
+            ('type', '=', 'task'),
+            ('parent', '=', project.id),
+            (start_field, '!=', None),
+            (start_field, '<=', end),
+            ['OR',
+                (finish_field, '>=', start),
+                [
+                    (finish_field, '=', None),
+                    (start_field, '>=', start),
+                ],
+            ],
+        ])
+
+        cursor.execute(
+            'SELECT "%s".id, plan_tw.name, "%s".%s, "%s".%s' % (
+                self._table, self._table, start_field, self._table,
+                finish_field) + from_ + ' '
+            'JOIN "' + timesheet_work_obj._table + '" AS plan_tw '
+                'ON plan_tw.id = "' + self._table + '".work' + where + ' '
+            'ORDER BY "' + self._table + '".' + start_field, args
+        )
+
+        # The URL of the tasks differ only by the ID of the task
+        marker = 987654321
+        url_prefix, url_suffix = url_for(
+            'project.work.render_task', project_id=project.id, task_id=marker
+        ).rsplit(str(marker), 1)
+
+        events = []
+        for task_id, name, start_time, finish_time in cursor.fetchall():
+            event = {
+                'id': task_id,
+                'title': name,
+                'url': '%s%d%s' % (url_prefix, task_id, url_suffix),
+                'start': start_time.isoformat(),
+            }
+            if finish_time:
+                event['end'] = finish_time.isoformat()
+            events.append(event)
+        return events
+
     @login_required
     def render_plan(self, project_id):
         """
@@ -1137,53 +2155,24 @@ class Project(ModelSQL, ModelView):
             end = datetime.fromtimestamp(
                 request.args.get('end', type=int)
             )
+            event_type = request.args['event_type']
+            if event_type not in PLAN_EVENT_TYPES:
+                abort(400)
+
             # TODO: These times are local times of the user, convert them to
             # UTC (Server time) before using them for comparison
-            task_ids = self.search(['AND',
-                ('type', '=', 'task'),
-                ('parent', '=', project.id),
-                ['OR',
-                    [
-                       ('constraint_start_time', '>=', start),
-                    ],
-                    [
-                        ('constraint_finish_time', '<=', end),
-                    ],
-                    [
-                       ('actual_start_time', '>=', start),
-                    ],
-                    [
-                        ('actual_finish_time', '<=', end),
-                    ],
-                ]
-            ])
-            tasks = self.browse(task_ids)
-            event_type = request.args['event_type']
-            assert event_type in ('constraint', 'actual')
-
-            def to_event(task, type="constraint"):
-                event = {
-                    'id': task.id,
-                    'title': task.name,
-                    'url': url_for(
-                        'project.work.render_task',
-                        project_id=task.parent.id, task_id=task.id),
-                }
-                event["start"] = getattr(
-                    task, '%s_start_time' % type
-                ).isoformat()
-                if getattr(task, '%s_finish_time' % type):
-                    event['end'] = getattr(
-                        task, '%s_finish_time' % type
-                    ).isoformat()
-                return event
-
-            return jsonify(
-                result = [
-                    # Send all events where there is a start time
-                    to_event(task, event_type) for task in tasks \
-                        if getattr(task, '%s_start_time' % event_type)
-                ]
+            return conditional_json(
+                ('plan', project.id, event_type, start, end,
+                    self._get_scope()),
+                self._get_change_marker('project.work', [
+                    ('type', '=', 'task'),
+                    ('parent', '=', project.id),
+                ]),
+                lambda: jsonify(
+                    result=self.get_plan_events(
+                        project, event_type, start, end
+                    )
+                )
             )
 
         return render_template(
@@ -1216,13 +2205,45 @@ class Project(ModelSQL, ModelView):
         if not attachment_ids:
             raise abort(404)
 
-        attachment = attachment_obj.browse(attachment_ids[0])
-        with tempfile.NamedTemporaryFile(delete=False) as f:
-            f.write(attachment.data)
+        # Only read the metadata, the data is streamed from the file store
+        attachment = attachment_obj.read(attachment_ids[0], [
+            'name', 'type', 'link', 'digest', 'collision', 'create_date',
+            'write_date',
+        ])
+        if attachment['type'] == 'link':
+            return redirect(attachment['link'])
+
+        if not attachment['digest']:
+            raise abort(404)
+        filename = get_filename(
+            attachment['digest'], attachment['collision']
+        )
+        if not os.path.isfile(filename):
+            raise abort(404)
+
+        return send_stored_file(
+            filename, attachment['name'],
+            etag='%s-%s' % (
+                attachment['digest'], attachment['collision'] or 0
+            ),
+            last_modified=attachment['write_date'] or \
+                attachment['create_date']
+        )
 
-        return send_file(
-            f.name, attachment_filename=attachment.name, as_attachment=True
+    def _file_too_large(self, max_size):
+        """
+        Response for an upload larger than the maximum size allowed
+        """
+        message = "The file is too large. Files can be at most %d MB." % (
+            max_size / (1024 * 1024)
         )
+        if request.is_xhr:
+            return jsonify({
+                'success': False,
+                'error': message,
+            })
+        flash(message)
+        return redirect(request.referrer)
 
     @login_required
     def upload_file(self):
@@ -1232,6 +2253,11 @@ class Project(ModelSQL, ModelView):
         """
         attachment_obj = Pool().get('ir.attachment')
 
+        max_size = get_max_size()
+        if request.content_length and request.content_length > max_size:
+            # Refuse before the body of the request is read
+            return self._file_too_large(max_size)
+
         work = None
         if request.form.get('project', None):
             work = self.get_project(request.form.get('project', type=int))
@@ -1242,11 +2268,10 @@ class Project(ModelSQL, ModelView):
             # Neither task, nor the project is specified
             raise abort(404)
 
-        attached_file =  request.files["file"]
-
         data = {
             'resource': '%s,%d' % (self._name, work.id),
-            'description': request.form.get('description', '')
+            'description': request.form.get('description', ''),
+            'uploaded_by': request.nereid_user.id,
         }
 
         if request.form.get('file_type') == 'link':
@@ -1257,8 +2282,18 @@ class Project(ModelSQL, ModelView):
                 'type': 'link'
             })
         else:
+            attached_file =  request.files["file"]
+            try:
+                digest, collision, size = store_stream(
+                    attached_file.stream, max_size
+                )
+            except FileTooLarge:
+                return self._file_too_large(max_size)
+            # Only the reference to the stored file goes to the database
             data.update({
-                'data': attached_file.stream.read(),
+                'digest': digest,
+                'collision': collision,
+                'file_size': size,
                 'name': attached_file.filename,
                 'type': 'data'
             })
@@ -1281,55 +2316,27 @@ class Project(ModelSQL, ModelView):
         :param task_id: The ID of the task which needs to be updated
         """
         history_obj = Pool().get('project.work.history')
-        timesheet_line_obj = Pool().get('timesheet.line')
 
         task = self.get_task(task_id)
 
-        history_data = {
-            'project': task.id,
-            'updated_by': request.nereid_user.id,
-            'comment': request.form['comment']
-        }
-
-        updatable_attrs = ['state', 'progress_state']
+        task_changes = {}
         new_participants = []
         current_participants = [p.id for p in task.participants]
-        post_attrs = [request.form.get(attr, None) for attr in updatable_attrs]
-
-        if any(post_attrs):
-            # Combined update of task and history since there is some value
-            # posted in addition to the comment
-            task_changes = {}
-            for attr in updatable_attrs:
-                if getattr(task, attr) != request.form.get(attr, None):
-                    task_changes[attr] = request.form[attr]
-
-            new_assignee = request.form.get('assigned_to', None, int)
-            if not new_assignee == None:
-                if (new_assignee and \
-                        (not task.assigned_to or \
-                            new_assignee != task.assigned_to.id)) \
-                        or (request.form.get('assigned_to', None) == ""): # Clear the user
-                    history_data['previous_assigned_to'] = \
-                        task.assigned_to and task.assigned_to.id or None
-                    history_data['new_assigned_to'] = new_assignee
-                    task_changes['assigned_to'] = new_assignee
-                    if new_assignee and new_assignee not in current_participants:
-                        new_participants.append(new_assignee)
-
-            if task_changes:
-                # Only write change if anything has really changed
-                self.write(task.id, task_changes)
-                comment_id = self.browse(task.id).history[-1].id
-                history_obj.write(comment_id, history_data)
-            else:
-                # just create comment since nothing really changed since this
-                # update. This is to cover to cover cases where two users who
-                # havent refreshed the web page close the ticket
-                comment_id = history_obj.create(history_data)
-        else:
-            # Just comment, no update to task
-            comment_id = history_obj.create(history_data)
+
+        for attr in ('state', 'progress_state'):
+            value = request.form.get(attr, None)
+            if value and getattr(task, attr) != value:
+                task_changes[attr] = value
+
+        new_assignee = request.form.get('assigned_to', None, int)
+        if not new_assignee == None:
+            if (new_assignee and \
+                    (not task.assigned_to or \
+                        new_assignee != task.assigned_to.id)) \
+                    or (request.form.get('assigned_to', None) == ""): # Clear the user
+                task_changes['assigned_to'] = new_assignee
+                if new_assignee and new_assignee not in current_participants:
+                    new_participants.append(new_assignee)
 
         if request.nereid_user.id not in current_participants:
             # Add the user to the participants if not already in the list
@@ -1341,18 +2348,11 @@ class Project(ModelSQL, ModelView):
             if nereid_user not in current_participants:
                 new_participants.append(nereid_user)
 
-        if new_participants:
-            self.write(
-                task.id, {'participants': [('add', new_participants)]}
-            )
-
-        hours = request.form.get('hours', None, type=float)
-        if hours and request.nereid_user.employee:
-            timesheet_line_obj.create({
-                'employee': request.nereid_user.employee.id,
-                'hours': hours,
-                'work': task.id
-            })
+        comment_id, task_state = self.apply_task_update(
+            task, task_changes, comment=request.form['comment'],
+            new_participants=new_participants,
+            hours=request.form.get('hours', None, type=float),
+        )
 
         # Send the email since all thats required is done
         history_obj.send_mail(comment_id)
@@ -1364,11 +2364,71 @@ class Project(ModelSQL, ModelView):
             return jsonify({
                 'success': True,
                 'html': html,
-                'state': self.browse(task.id).state,
-                'progress_state': self.browse(task.id).progress_state,
+                'state': task_state['state'],
+                'progress_state': task_state['progress_state'],
             })
         return redirect(request.referrer)
 
+    def apply_task_update(self, task, changes, comment=None,
+            new_participants=None, hours=None):
+        """
+        Applies an update of a task made by the current user. The changed
+        fields and the new participants are saved in a single write and
+        the update, with its comment, is recorded as one history line.
+
+        Returns the ID of the history line and a dictionary with the state
+        and the progress state of the task after the update, so the task
+        does not have to be read again.
+
+        :param task: Browse record of the task
+        :param changes: Dictionary of the changed fields of the task
+        :param comment: The comment of the update
+        :param new_participants: IDs of the users to add as participants
+        :param hours: Hours spent by the current user on the task
+        """
+        history_obj = Pool().get('project.work.history')
+        timesheet_line_obj = Pool().get('timesheet.line')
+
+        history_data = {
+            'project': task.id,
+            'updated_by': request.nereid_user.id,
+            'comment': comment,
+        }
+        for field, value in changes.iteritems():
+            if field not in HISTORIZED_FIELDS:
+                continue
+            previous = getattr(task, field)
+            if hasattr(previous, 'id'):
+                previous = previous.id
+            history_data['previous_%s' % field] = previous
+            history_data['new_%s' % field] = value
+
+        values = dict(changes)
+        if new_participants:
+            values['participants'] = [('add', list(set(new_participants)))]
+        # The task and its project are touched once, below
+        with Transaction().set_context(skip_activity=True):
+            if values:
+                # The history line is created below along with the comment
+                with Transaction().set_context(skip_history=True):
+                    self.write(task.id, values)
+            history_id = history_obj.create(history_data)
+
+            if hours and request.nereid_user.employee:
+                timesheet_line_obj.create({
+                    'employee': request.nereid_user.employee.id,
+                    'hours': hours,
+                    'work': task.id
+                })
+        self.touch_activity([task.id])
+
+        return history_id, {
+            'state': changes.get('state', task.state),
+            'progress_state': changes.get(
+                'progress_state', task.progress_state
+            ),
+        }
+
     @login_required
     def add_tag(self, task_id, tag_id):
         """Assigns the provided to this task
@@ -1421,10 +2481,20 @@ class Project(ModelSQL, ModelView):
         if isinstance(ids, (int, long)):
             ids = [ids]
 
-        for project in self.browse(ids):
-            work_history_obj.create_history_line(project, values)
+        if 'participants' in values:
+            request_cache('project_participant').clear()
+
+        if not Transaction().context.get('skip_history'):
+            work_history_obj.create_history_lines(ids, values)
 
-        return super(Project, self).write(ids, values)
+        rv = super(Project, self).write(ids, values)
+        if 'name' in values or 'comment' in values:
+            Pool().get('project.work.search').update_index(ids)
+        if values.get('constraint_finish_time') and \
+                'work_period' not in values:
+            self.assign_work_periods(ids)
+        self.touch_activity(ids)
+        return rv
 
     @login_required
     def mark_time(self, task_id):
@@ -1466,12 +2536,10 @@ class Project(ModelSQL, ModelView):
             return redirect(request.referrer)
 
         if self.can_write(task.parent, new_assignee):
-            self.write(task.id, {
-                'assigned_to': new_assignee.id,
-                'participants': [('add', [new_assignee.id])]
-            })
-
-            comment_id = self.browse(task.id).history[-1].id
+            comment_id, _ = self.apply_task_update(
+                task, {'assigned_to': new_assignee.id},
+                new_participants=[new_assignee.id]
+            )
             history_obj.send_mail(comment_id)
 
             if request.is_xhr:
@@ -1605,6 +2673,50 @@ class Project(ModelSQL, ModelView):
 Project()
 
 
+class TimesheetLine(ModelSQL, ModelView):
+    """
+    Timesheet Line
+    """
+    _name = 'timesheet.line'
+
+    def init(self, module_name):
+        super(TimesheetLine, self).init(module_name)
+        table = TableHandler(Transaction().cursor, self, module_name)
+
+        # The calendars aggregate the hours by date and employee
+        table.index_action(['date', 'employee'], 'add')
+
+        # The activity stream pages the lines of the works by date
+        table.index_action(['work', 'create_date'], 'add')
+
+    def create(self, values):
+        project_obj = Pool().get('project.work')
+
+        line_id = super(TimesheetLine, self).create(values)
+        project_obj.touch_activity([values.get('work')], column='work')
+        return line_id
+
+TimesheetLine()
+
+
+class TimesheetWork(ModelSQL, ModelView):
+    """
+    Timesheet Work
+
+    The parent and the company of the projects and tasks are stored here
+    """
+    _name = 'timesheet.work'
+
+    def write(self, ids, values):
+        if 'parent' in values or 'company' in values:
+            # The participants of a work are those of its parents and the
+            # project admins of its company
+            Pool().get('project.work')._all_participant_ids.reset()
+        return super(TimesheetWork, self).write(ids, values)
+
+TimesheetWork()
+
+
 class ProjectTag(ModelSQL, ModelView):
     "Tags"
     _name = "project.work.tag"
@@ -1728,6 +2840,8 @@ class ProjectHistory(ModelSQL, ModelView):
 
     # Comment
     comment = fields.Text('Comment')
+    #: The comment rendered to HTML when it is saved
+    comment_html = fields.Text('Comment HTML', readonly=True)
 
     # Name
     previous_name = fields.Char('Prev. Name')
@@ -1744,33 +2858,120 @@ class ProjectHistory(ModelSQL, ModelView):
     previous_constraint_finish_time = fields.DateTime("Constraint  Finish Time")
     new_constraint_finish_time = fields.DateTime("Constraint  Finish Time")
 
+    def init(self, module_name):
+        super(ProjectHistory, self).init(module_name)
+        table = TableHandler(Transaction().cursor, self, module_name)
+
+        # The activity stream pages the history of the works by date
+        table.index_action(['project', 'create_date'], 'add')
+
     def default_date(self):
         return datetime.utcnow()
 
-    def create_history_line(self, project, changed_values):
+    def create(self, values):
+        project_obj = Pool().get('project.work')
+
+        if values.get('comment'):
+            values = values.copy()
+            values['comment_html'] = rst_to_html(values['comment'])
+        history_id = super(ProjectHistory, self).create(values)
+        if values.get('comment'):
+            Pool().get('project.work.search').update_index(
+                [values['project']]
+            )
+        project_obj.touch_activity([values.get('project')])
+        return history_id
+
+    def write(self, ids, values):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if 'comment' in values:
+            values = values.copy()
+            values['comment_html'] = rst_to_html(values['comment'])
+        rv = super(ProjectHistory, self).write(ids, values)
+        if 'comment' in values:
+            Pool().get('project.work.search').update_index(
+                [h.project.id for h in self.browse(ids)]
+            )
+            self._render_email_fragment.reset()
+        return rv
+
+    def get_email_fragment(self, history_id):
         """
-        Creates a history line from the changed values of a project.work
+        Returns the text and the HTML of a history line as it is shown in
+        the thread of the notification emails. The fragments are cached by
+        language, so a line is rendered once for all the emails in the same
+        language which include it.
+
+        :param history_id: ID of the history line
         """
-        if changed_values:
-            data = {}
+        return self._render_email_fragment(
+            history_id, Transaction().language
+        )
 
-            # TODO: Also create a line when assigned user is cleared from task
-            for field in ('assigned_to', 'state', 'progress_state',
-                    'constraint_start_time', 'constraint_finish_time'):
-                if field not in changed_values or not changed_values[field]:
-                    continue
-                data['previous_%s' % field] = getattr(project, field)
-                data['new_%s' % field] = changed_values[field]
-
-            if data:
-                if has_request_context():
-                    data['updated_by'] = request.nereid_user.id
-                else:
-                    # TODO: try to find the nereid user from the employee
-                    # if an employee made the update
-                    pass
-                data['project'] = project.id
-                return self.create(data)
+    @Cache('project_work_history.email_fragment', context=False)
+    def _render_email_fragment(self, history_id, language):
+        """
+        Renders the fragments of a history line. The language is part of
+        the key of the cache because the dates are formatted for the locale.
+
+        :param history_id: ID of the history line
+        :param language: The code of the language of the transaction
+        """
+        history = self.browse(history_id)
+        return (
+            unicode(render_template(
+                'project/emails/history-line-text.jinja', h_line=history
+            )),
+            unicode(render_template(
+                'project/emails/history-line-html.jinja', h_line=history
+            )),
+        )
+
+    def create_history_lines(self, ids, changed_values):
+        """
+        Creates the history lines of the project.work records from the
+        changed values. Nothing is read when none of the historized fields
+        change, else the previous values are read at once and the lines
+        are inserted in bulk.
+
+        Inserting in bulk skips ProjectHistory.create, which is safe here:
+        these lines never carry a comment, so there is nothing to index or
+        render, and the caller, Project.write, touches the activity of the
+        works itself.
+
+        :param ids: IDs of the project.work records
+        :param changed_values: The values written
+        """
+        project_obj = Pool().get('project.work')
+
+        # TODO: Also create a line when assigned user is cleared from task
+        fields_changed = [
+            field for field in HISTORIZED_FIELDS if changed_values.get(field)
+        ]
+        if not ids or not fields_changed:
+            return
+
+        updated_by = None
+        if has_request_context():
+            updated_by = request.nereid_user.id
+        else:
+            # TODO: try to find the nereid user from the employee
+            # if an employee made the update
+            pass
+
+        columns = ['project', 'date', 'updated_by']
+        for field in fields_changed:
+            columns.extend(['previous_%s' % field, 'new_%s' % field])
+
+        now = datetime.utcnow()
+        rows = []
+        for previous in project_obj.read(ids, fields_changed):
+            row = [previous['id'], now, updated_by]
+            for field in fields_changed:
+                row.extend([previous[field], changed_values[field]])
+            rows.append(tuple(row))
+        bulk_insert(self._table, columns, rows)
 
     def get_function_fields(self, ids, names):
         """
@@ -1824,15 +3025,25 @@ class ProjectHistory(ModelSQL, ModelView):
 
         :param history_id: ID of history.
         """
+        project_obj = Pool().get('project.work')
+
         history = self.browse(history_id)
 
-        # Get the previous updates than the latest one.
-        history_ids = self.search([
+        # Only the latest of the previous updates are included, the rest of
+        # the thread is linked
+        domain = [
             ('id', '<', history_id),
-            ('project.id', '=', history.project.id)
-        ], order=[('create_date', 'DESC')])
-
-        last_history = self.browse(history_ids)
+            ('project', '=', history.project.id)
+        ]
+        history_ids = self.search(
+            domain, order=[('create_date', 'DESC'), ('id', 'DESC')],
+            limit=EMAIL_HISTORY_LIMIT
+        )
+        last_history = [self.get_email_fragment(h_id) for h_id in history_ids]
+        if len(history_ids) < EMAIL_HISTORY_LIMIT:
+            older_count = 0
+        else:
+            older_count = self.search_count(domain) - len(history_ids)
 
         # Prepare the content of email.
         subject = "[#%s %s] - %s" % (
@@ -1840,9 +3051,20 @@ class ProjectHistory(ModelSQL, ModelView):
             history.project.work.name,
         )
 
-        receivers = [s.email for s in history.project.participants
-                     if s.email]
-        receivers.remove(history.updated_by.email)
+        participants = [
+            s for s in history.project.participants
+            if s.email and s.email != history.updated_by.email
+        ]
+
+        # Users who opted in for a digest get the update in the next one
+        digest_ids = project_obj.get_digest_subscriber_ids(
+            history.project.parent.id
+        )
+        Pool().get('project.work.notification').defer(
+            history.project,
+            [s for s in participants if s.id in digest_ids], history
+        )
+        receivers = [s.email for s in participants if s.id not in digest_ids]
 
         if not receivers:
             return
@@ -1854,16 +3076,15 @@ class ProjectHistory(ModelSQL, ModelView):
             text_template='project/emails/text_content.jinja',
             html_template='project/emails/html_content.jinja',
             history=history,
-            last_history=last_history
+            last_history=last_history,
+            older_count=older_count
         )
 
         #message.add_header('reply-to', request.nereid_user.email)
 
-        # Send mail.
-        server = get_smtp_server()
-        server.sendmail(CONFIG['smtp_from'], receivers,
-            message.as_string())
-        server.quit()
+        Pool().get('project.work.outbox').queue_mail(
+            CONFIG['smtp_from'], receivers, message
+        )
 
 ProjectHistory()
 
@@ -1887,82 +3108,337 @@ class ProjectWorkCommit(ModelSQL, ModelView):
     commit_url = fields.Char('Commit URL', required=True)
     commit_id = fields.Char('Commit Id', required=True)
 
-    def commit_github_hook_handler(self):
-        """Handle post commit posts from GitHub
-        See https://help.github.com/articles/post-receive-hooks
+    def __init__(self):
+        super(ProjectWorkCommit, self).__init__()
+        self._sql_constraints += [
+            ('commit_project_uniq', 'UNIQUE(commit_id, project)',
+                'A commit can be linked only once to a task!'),
+        ]
+
+    def init(self, module_name):
+        cursor = Transaction().cursor
+        if TableHandler.table_exist(cursor, self._table):
+            # Remove the duplicates left by redelivered hooks, else the
+            # unique constraint cannot be added
+            cursor.execute(
+                'DELETE FROM "' + self._table + '" WHERE id NOT IN ('
+                    'SELECT MIN(id) FROM "' + self._table + '" '
+                    'GROUP BY commit_id, project'
+                ')'
+            )
+        super(ProjectWorkCommit, self).init(module_name)
+        table = TableHandler(cursor, self, module_name)
+
+        # The activity stream pages the commits of the works by date
+        table.index_action(['project', 'create_date'], 'add')
+
+    def create(self, values):
+        project_obj = Pool().get('project.work')
+
+        commit_id = super(ProjectWorkCommit, self).create(values)
+        Pool().get('project.work.search').update_index([values['project']])
+        project_obj.touch_activity([values['project']])
+        return commit_id
+
+    def _get_user_ids_by_email(self, emails):
+        """
+        Returns a dictionary of the nereid user ID of each email which
+        belongs to a user
+
+        :param emails: List of email addresses
         """
         nereid_user_obj = Pool().get('nereid.user')
+        cursor = Transaction().cursor
 
-        if request.method == "POST":
-            payload = json.loads(request.form['payload'])
-            for commit in payload['commits']:
-                nereid_user_ids = nereid_user_obj.search([
-                    ('email', '=', commit['author']['email'])
-                ])
-                if not nereid_user_ids:
+        emails = list(set(emails))
+        user_ids = {}
+        for i in range(0, len(emails), cursor.IN_MAX):
+            sub_emails = emails[i:i + cursor.IN_MAX]
+            cursor.execute(
+                'SELECT email, MIN(id) FROM "' + nereid_user_obj._table + '" '
+                'WHERE email IN (' + ','.join(['%s'] * len(sub_emails)) + ') '
+                'GROUP BY email', sub_emails
+            )
+            user_ids.update(cursor.fetchall())
+        return user_ids
+
+    def _get_task_ids(self, ids):
+        """
+        Returns the set of the given IDs which are tasks
+
+        :param ids: List of IDs referenced in commit messages
+        """
+        project_obj = Pool().get('project.work')
+        cursor = Transaction().cursor
+
+        ids = list(set(ids))
+        task_ids = set()
+        for i in range(0, len(ids), cursor.IN_MAX):
+            red_sql, red_ids = reduce_ids('id', ids[i:i + cursor.IN_MAX])
+            cursor.execute(
+                'SELECT id FROM "' + project_obj._table + '" '
+                'WHERE ' + red_sql + ' AND type = %s', red_ids + ['task']
+            )
+            task_ids.update(row[0] for row in cursor.fetchall())
+        return task_ids
+
+    def _get_existing(self, commit_ids):
+        """
+        Returns the set of (commit_id, project) already stored for the given
+        commits
+
+        :param commit_ids: List of commit hashes
+        """
+        cursor = Transaction().cursor
+
+        commit_ids = list(set(commit_ids))
+        existing = set()
+        for i in range(0, len(commit_ids), cursor.IN_MAX):
+            sub_ids = commit_ids[i:i + cursor.IN_MAX]
+            cursor.execute(
+                'SELECT commit_id, project FROM "' + self._table + '" '
+                'WHERE commit_id IN (' + ','.join(['%s'] * len(sub_ids)) + ')',
+                sub_ids
+            )
+            existing.update(cursor.fetchall())
+        return existing
+
+    def ingest_commits(self, commits):
+        """
+        Links a batch of commits to the tasks referenced in their messages.
+        The authors and the tasks are looked up once for the whole batch and
+        the rows are inserted in bulk. Commits of unknown authors, references
+        to works which are not tasks and commits already linked to a task
+        are skipped, so a batch can be ingested more than once.
+
+        Returns the number of rows inserted.
+
+        :param commits: List of dictionaries with the keys commit_id,
+                        message, email, timestamp (a datetime, in UTC when
+                        it is naive), url, repository and repository_url
+        """
+        user_ids = self._get_user_ids_by_email([c['email'] for c in commits])
+        references = dict(
+            (commit['commit_id'], set(
+                int(x) for x in TASK_REFERENCE_RE.findall(
+                    commit['message'] or ''
+                )
+            )) for commit in commits if commit['email'] in user_ids
+        )
+        task_ids = self._get_task_ids(
+            [task_id for ids in references.values() for task_id in ids]
+        )
+        existing = self._get_existing(references.keys())
+
+        rows = []
+        for commit in commits:
+            if commit['email'] not in user_ids:
+                continue
+            commit_timestamp = commit['timestamp']
+            if commit_timestamp.tzinfo is not None:
+                # Timestamps without a timezone are taken as UTC
+                commit_timestamp = commit_timestamp.astimezone(
+                    dateutil.tz.tzutc()
+                ).replace(tzinfo=None)
+            for task_id in references[commit['commit_id']] & task_ids:
+                key = (commit['commit_id'], task_id)
+                if key in existing:
                     continue
+                existing.add(key)
+                rows.append((
+                    commit_timestamp, task_id, user_ids[commit['email']],
+                    commit['repository'], commit['repository_url'],
+                    commit['message'], commit['url'], commit['commit_id'],
+                ))
+        if not rows:
+            return 0
+
+        bulk_insert(self._table, [
+            'commit_timestamp', 'project', 'nereid_user', 'repository',
+            'repository_url', 'commit_message', 'commit_url', 'commit_id',
+        ], rows)
+        updated_ids = list(set(row[1] for row in rows))
+        Pool().get('project.work.search').update_index(updated_ids)
+        Pool().get('project.work').touch_activity(updated_ids)
+        return len(rows)
+
+    def backfill_from_git(self, repo_path, repository, repository_url,
+            commit_url, batch_size=5000):
+        """
+        Links the commits of a local git repository to the tasks they
+        reference. The log is streamed and ingested in batches, so this is
+        a generator which yields the number of rows inserted after every
+        batch. The caller can commit the transaction in between. The last
+        activity of the projects is not changed.
+
+        :param repo_path: Path of the git repository
+        :param repository: Name of the repository
+        :param repository_url: URL of the repository
+        :param commit_url: URL of a commit with %s in place of the hash
+        :param batch_size: Number of commits ingested at once
+        """
+        batch = []
+        for commit in iter_git_log(repo_path):
+            commit.update({
+                'url': commit_url % commit['commit_id'],
+                'repository': repository,
+                'repository_url': repository_url,
+            })
+            batch.append(commit)
+            if len(batch) >= batch_size:
+                yield self._backfill_batch(batch)
+                batch = []
+        if batch:
+            yield self._backfill_batch(batch)
 
-                projects = [int(x) for x in re.findall(r'#(\d+)', commit['message'])]
-                for project in projects:
-                    local_commit_time = dateutil.parser.parse(
-                        commit['timestamp']
-                    )
-                    commit_timestamp = local_commit_time.astimezone(
-                        dateutil.tz.tzutc()
-                    )
-                    self.create({
-                        'commit_timestamp': commit_timestamp,
-                        'project': project,
-                        'nereid_user': nereid_user_ids[0],
-                        'repository': payload['repository']['name'],
-                        'repository_url': payload['repository']['url'],
-                        'commit_message': commit['message'],
-                        'commit_url': commit['url'],
-                        'commit_id': commit['id']
-                    })
-        return 'OK'
+    def _backfill_batch(self, commits):
+        """
+        Ingests a batch of old commits. The last activity of the projects is
+        left as it is, so backfilling does not bring dormant projects to the
+        top of the home page.
+        """
+        with Transaction().set_context(skip_activity=True):
+            return self.ingest_commits(commits)
 
-    def commit_bitbucket_hook_handler(self):
-        """Handle post commit posts from bitbucket
+    def parse_github_payload(self, payload):
+        """
+        Returns the commits of a GitHub post receive payload in the format
+        of ingest_commits
+        See https://help.github.com/articles/post-receive-hooks
+
+        :param payload: The decoded JSON payload
+        """
+        return [{
+            'commit_id': commit['id'],
+            'message': commit['message'],
+            'email': commit['author']['email'],
+            'timestamp': dateutil.parser.parse(commit['timestamp']),
+            'url': commit['url'],
+            'repository': payload['repository']['name'],
+            'repository_url': payload['repository']['url'],
+        } for commit in payload['commits']]
+
+    def parse_bitbucket_payload(self, payload):
+        """
+        Returns the commits of a Bitbucket POST service payload in the
+        format of ingest_commits
         See https://confluence.atlassian.com/display/BITBUCKET/POST+Service+Management
+
+        :param payload: The decoded JSON payload
         """
-        nereid_user_obj = Pool().get('nereid.user')
+        repository_url = payload['canon_url'] + \
+            payload['repository']['absolute_url']
+        return [{
+            'commit_id': commit['raw_node'],
+            'message': commit['message'],
+            'email': parseaddr(commit['raw_author'])[1],
+            'timestamp': dateutil.parser.parse(commit['utctimestamp']),
+            'url': repository_url + "changeset/" + commit['raw_node'],
+            'repository': payload['repository']['name'],
+            'repository_url': repository_url,
+        } for commit in payload['commits']]
 
+    def commit_github_hook_handler(self):
+        """Handle post commit posts from GitHub. The payload is queued and
+        processed by a cron job.
+        """
         if request.method == "POST":
-            payload = json.loads(request.form['payload'])
-            for commit in payload['commits']:
-                nereid_user_ids = nereid_user_obj.search([
-                    ('email', '=', parseaddr(commit['raw_author'])[1])
-                ])
-                if not nereid_user_ids:
-                    continue
+            Pool().get('project.work.commit.hook').create({
+                'source': 'github',
+                'payload': request.form['payload'],
+            })
+            return 'Accepted', 202
+        return 'OK'
 
-                projects = [int(x) for x in re.findall(r'#(\d+)', commit['message'])]
-                for project in projects:
-                    local_commit_time = dateutil.parser.parse(
-                        commit['utctimestamp']
-                    )
-                    commit_timestamp = local_commit_time.astimezone(
-                        dateutil.tz.tzutc()
-                    )
-                    self.create({
-                        'commit_timestamp': commit_timestamp,
-                        'project': project,
-                        'nereid_user': nereid_user_ids[0],
-                        'repository': payload['repository']['name'],
-                        'repository_url': payload['canon_url'] + \
-                            payload['repository']['absolute_url'],
-                        'commit_message': commit['message'],
-                        'commit_url': payload['canon_url'] + \
-                            payload['repository']['absolute_url'] + \
-                            "changeset/" + commit['raw_node'],
-                        'commit_id': commit['raw_node']
-                    })
+    def commit_bitbucket_hook_handler(self):
+        """Handle post commit posts from bitbucket. The payload is queued and
+        processed by a cron job.
+        """
+        if request.method == "POST":
+            Pool().get('project.work.commit.hook').create({
+                'source': 'bitbucket',
+                'payload': request.form['payload'],
+            })
+            return 'Accepted', 202
         return 'OK'
 
 ProjectWorkCommit()
 
 
+class ProjectWorkCommitHook(ModelSQL):
+    "Repository Hook Delivery"
+    _name = 'project.work.commit.hook'
+    _description = __doc__
+
+    source = fields.Selection([
+        ('github', 'GitHub'),
+        ('bitbucket', 'Bitbucket'),
+    ], 'Source', required=True)
+    payload = fields.Text('Payload', required=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, select=True)
+    error = fields.Text('Error')
+
+    def default_state(self):
+        return 'pending'
+
+    def process_pending(self, limit=50):
+        """
+        Ingests the commits of the pending hook deliveries and purges the
+        old processed ones. This is called by the cron job.
+
+        Every delivery is ingested within a savepoint. A delivery which
+        fails is rolled back alone and marked as failed with the error, so
+        it neither undoes the other deliveries of the run nor blocks the
+        next runs.
+
+        :param limit: The maximum number of deliveries processed in one run
+        """
+        commit_obj = Pool().get('project.work.commit')
+        cursor = Transaction().cursor
+        parsers = {
+            'github': commit_obj.parse_github_payload,
+            'bitbucket': commit_obj.parse_bitbucket_payload,
+        }
+
+        ids = self.search([('state', '=', 'pending')], limit=limit)
+        for delivery in self.browse(ids):
+            cursor.execute('SAVEPOINT commit_hook_delivery')
+            try:
+                commit_obj.ingest_commits(
+                    parsers[delivery.source](json.loads(delivery.payload))
+                )
+            except Exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT commit_hook_delivery')
+                self.write(delivery.id, {
+                    'state': 'failed',
+                    'error': traceback.format_exc().decode('utf-8', 'replace'),
+                })
+            else:
+                cursor.execute('RELEASE SAVEPOINT commit_hook_delivery')
+                self.write(delivery.id, {'state': 'done'})
+
+        self.purge_done()
+        return True
+
+    def purge_done(self):
+        """
+        Deletes the deliveries processed more than HOOK_RETENTION_DAYS ago.
+        The failed deliveries are kept for inspection.
+        """
+        cursor = Transaction().cursor
+        cursor.execute(
+            'DELETE FROM "' + self._table + '" '
+            'WHERE state = %s AND write_date < %s',
+            ('done', datetime.now() - timedelta(days=HOOK_RETENTION_DAYS))
+        )
+
+ProjectWorkCommitHook()
+
+
 @registration.connect
 def invitation_new_user_handler(nereid_user_id):
     """When the invite is sent to a new user, he is sent an invitation key
@@ -2017,9 +3493,9 @@ def invitation_new_user_handler(nereid_user_id):
         subject=subject, to=', '.join(receivers),
         from_email=CONFIG['smtp_from'], invitation=invitation
     )
-    server = get_smtp_server()
-    server.sendmail(CONFIG['smtp_from'], receivers, email_message.as_string())
-    server.quit()
+    Pool().get('project.work.outbox').queue_mail(
+        CONFIG['smtp_from'], receivers, email_message
+    )
 
     project_obj.write(
         invitation.project.id, {
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+    search
+
+    Full text search over tasks
+
+    The searchable document of a task is made of its name, its description,
+    the comments in its history and the messages of the commits referring to
+    it. The documents are kept in project.work.search and indexed by a
+    backend which depends on the database:
+
+    * PostgreSQL uses a GIN index on the tsvector of the document
+    * SQLite uses an FTS5 virtual table (used for local tests)
+    * Any other database falls back to a LIKE on the document
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from trytond.tools import reduce_ids
+
+from utils import rule_filtered_sql, bulk_insert
+
+
+class LikeBackend(object):
+    """
+    Fallback backend which does not use any index. The results are not
+    ranked and are ordered by the most recent task first.
+
+    The scope given to search is a tuple of a query selecting the ids of
+    the tasks to search in and its arguments. It is applied by the database
+    before the results are limited.
+    """
+
+    def _scope(self, column, scope):
+        """
+        Returns the condition restricting the column to the scope and its
+        arguments
+        """
+        if not scope:
+            return '', []
+        scope_sql, scope_args = scope
+        return ' AND ' + column + ' IN (' + scope_sql + ')', list(scope_args)
+
+    def init(self, cursor, table):
+        pass
+
+    def delete(self, cursor, table, ids):
+        pass
+
+    def insert(self, cursor, table, work_id, document):
+        pass
+
+    def search(self, cursor, table, query, limit, scope=None):
+        scope_sql, scope_args = self._scope('work', scope)
+        cursor.execute(
+            'SELECT work FROM "' + table + '" '
+            'WHERE document LIKE %s' + scope_sql + ' '
+            'ORDER BY work DESC LIMIT %s',
+            ['%%%s%%' % query] + scope_args + [limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class PostgreSQLBackend(LikeBackend):
+    """
+    Uses a GIN index on the tsvector of the document and ranks the results
+    with ts_rank. The documents and the queries are parsed with the
+    'simple' text search configuration, which is language neutral: the
+    words are not stemmed, so a search matches the exact words only (a
+    search for "report" does not match "reports").
+    """
+    #: The text search configuration used for the tsvector
+    ts_config = 'simple'
+
+    def _tsvector(self):
+        return "to_tsvector('%s', document)" % self.ts_config
+
+    def init(self, cursor, table):
+        index_name = table + '_document_gin'
+        cursor.execute(
+            'SELECT 1 FROM pg_indexes WHERE indexname = %s', (index_name,)
+        )
+        if not cursor.fetchone():
+            cursor.execute(
+                'CREATE INDEX "' + index_name + '" ON "' + table + '" '
+                'USING gin(' + self._tsvector() + ')'
+            )
+
+    def search(self, cursor, table, query, limit, scope=None):
+        scope_sql, scope_args = self._scope('work', scope)
+        cursor.execute(
+            'SELECT work FROM "' + table + '", '
+                "plainto_tsquery('" + self.ts_config + "', %s) AS query "
+            'WHERE ' + self._tsvector() + ' @@ query' + scope_sql + ' '
+            'ORDER BY ts_rank(' + self._tsvector() + ', query) DESC, '
+                'work DESC '
+            'LIMIT %s', [query] + scope_args + [limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class SQLiteBackend(LikeBackend):
+    """
+    Keeps the documents in an FTS5 virtual table whose rowid is the id of
+    the task. This is a stand-in for local tests.
+    """
+
+    def _fts_table(self, table):
+        return table + '_fts'
+
+    def init(self, cursor, table):
+        cursor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS "' + self._fts_table(table) + \
+                '" USING fts5(document)'
+        )
+
+    def delete(self, cursor, table, ids):
+        red_sql, red_ids = reduce_ids('rowid', ids)
+        cursor.execute(
+            'DELETE FROM "' + self._fts_table(table) + '" WHERE ' + red_sql,
+            red_ids
+        )
+
+    def insert(self, cursor, table, work_id, document):
+        cursor.execute(
+            'INSERT INTO "' + self._fts_table(table) + '" '
+            '(rowid, document) VALUES (%s, %s)', (work_id, document)
+        )
+
+    def search(self, cursor, table, query, limit, scope=None):
+        # Quote every term so that the user input is never interpreted as
+        # FTS5 query syntax
+        match = ' '.join(
+            '"%s"' % term.replace('"', '""') for term in query.split()
+        )
+        if not match:
+            return []
+        scope_sql, scope_args = self._scope('rowid', scope)
+        cursor.execute(
+            'SELECT rowid FROM "' + self._fts_table(table) + '" '
+            'WHERE "' + self._fts_table(table) + '" MATCH %s' + scope_sql + \
+            ' ORDER BY rank LIMIT %s', [match] + scope_args + [limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+#: The search backends by the database type. New backends can be registered
+#: here.
+BACKENDS = {
+    'postgresql': PostgreSQLBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+class TaskSearch(ModelSQL):
+    "Task Search Document"
+    _name = 'project.work.search'
+    _description = __doc__
+
+    work = fields.Many2One(
+        'project.work', 'Task', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    document = fields.Text('Document')
+
+    def get_backend(self):
+        """
+        Returns the search backend for the database in use
+        """
+        return BACKENDS.get(CONFIG['db_type'], LikeBackend)()
+
+    def init(self, module_name):
+        super(TaskSearch, self).init(module_name)
+        cursor = Transaction().cursor
+        self.get_backend().init(cursor, self._table)
+
+        cursor.execute('SELECT id FROM "' + self._table + '" LIMIT 1')
+        if not cursor.fetchone():
+            # Index the tasks which existed before the index
+            cursor.execute(
+                'SELECT id FROM "' + Pool().get('project.work')._table + '" '
+                'WHERE type = %s', ('task',)
+            )
+            task_ids = [row[0] for row in cursor.fetchall()]
+            for i in range(0, len(task_ids), cursor.IN_MAX):
+                self.update_index(task_ids[i:i + cursor.IN_MAX])
+
+    def _get_documents(self, ids):
+        """
+        Returns a dictionary with the searchable document of each of the
+        tasks. Works which are not tasks are left out.
+
+        :param ids: IDs of the works
+        """
+        pool = Pool()
+        cursor = Transaction().cursor
+        parts = {}
+
+        red_sql, red_ids = reduce_ids('w.id', ids)
+        cursor.execute(
+            'SELECT w.id, tw.name, w.comment '
+            'FROM "' + pool.get('project.work')._table + '" AS w '
+            'JOIN "' + pool.get('timesheet.work')._table + '" AS tw '
+                'ON tw.id = w.work '
+            'WHERE ' + red_sql + ' AND w.type = %s', red_ids + ['task']
+        )
+        for work_id, name, comment in cursor.fetchall():
+            parts[work_id] = [name or '', comment or '']
+        if not parts:
+            return {}
+
+        red_sql, red_ids = reduce_ids('project', parts.keys())
+        for model, column in (
+                ('project.work.history', 'comment'),
+                ('project.work.commit', 'commit_message')):
+            cursor.execute(
+                'SELECT project, ' + column + ' '
+                'FROM "' + pool.get(model)._table + '" '
+                'WHERE ' + red_sql + ' AND ' + column + ' IS NOT NULL '
+                'ORDER BY id', red_ids
+            )
+            for work_id, text in cursor.fetchall():
+                parts[work_id].append(text)
+
+        return dict(
+            (work_id, '\n'.join(texts)) for work_id, texts in parts.iteritems()
+        )
+
+    def update_index(self, ids):
+        """
+        Rebuilds the searchable documents of the given works. This is called
+        whenever a task, its history or its commits change.
+
+        :param ids: IDs of the works
+        """
+        cursor = Transaction().cursor
+        backend = self.get_backend()
+
+        ids = list(set(ids))
+        if not ids:
+            return
+        documents = self._get_documents(ids)
+
+        red_sql, red_ids = reduce_ids('work', ids)
+        cursor.execute(
+            'DELETE FROM "' + self._table + '" WHERE ' + red_sql, red_ids
+        )
+        backend.delete(cursor, self._table, ids)
+        bulk_insert(self._table, ['work', 'document'], documents.items())
+        for work_id, document in documents.iteritems():
+            backend.insert(cursor, self._table, work_id, document)
+
+    def search_tasks(self, query, domain=None, limit=1000):
+        """
+        Returns the ids of the tasks matching the query, best match first
+
+        :param query: The search string entered by the user
+        :param domain: The domain of project.work the results must match,
+                       like the project or the assignee of a task list. It
+                       is applied before the results are limited, so the
+                       limit never drops the matches within the domain.
+        :param limit: The maximum number of results
+        """
+        scope = None
+        if domain is not None:
+            work_obj = Pool().get('project.work')
+            from_, where, args = rule_filtered_sql(work_obj._name, domain)
+            scope = ('SELECT "' + work_obj._table + '".id' + from_ + where,
+                args)
+        return self.get_backend().search(
+            Transaction().cursor, self._table, query, limit, scope
+        )
+
+TaskSearch()
+
@@ -18,6 +18,7 @@ for dep in info.get('depends', []):
                     minor_version + 1))
 requires.append('trytond >= %s.%s, < %s.%s' %
         (major_version, minor_version, major_version, minor_version + 1))
+requires.append('docutils')
 
 setup(name='trytond_nereid_project',
     version=info.get('version', '0.0.1'),
@@ -30,6 +31,7 @@ setup(name='trytond_nereid_project',
     package_dir={'trytond.modules.nereid_project': '.'},
     packages=[
         'trytond.modules.nereid_project',
+        'trytond.modules.nereid_project.tests',
     ],
     package_data={
         'trytond.modules.nereid_project': info.get('xml', []) \
@@ -48,6 +50,8 @@ setup(name='trytond_nereid_project',
     license='GPL-3',
     install_requires=requires,
     zip_safe=False,
+    test_suite='tests',
+    test_loader='trytond.test_loader:Loader',
     entry_points="""
     [trytond.modules]
     nereid_project = trytond.modules.nereid_project
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+'''
+    nereid_project tests
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+'''
+import unittest
+
+import trytond.tests.test_tryton
+
+from test_search import TestSearch
+from test_outbox import TestOutbox
+from test_pagination import TestPagination
+from test_commits import TestCommits
+from test_period import TestPeriod
+from test_filestore import TestFileStore
+from test_activity import TestActivity
+
+
+def suite():
+    "Test suite of nereid_project"
+    suite = trytond.tests.test_tryton.suite()
+    loader = unittest.TestLoader()
+    for test_case in (TestSearch, TestOutbox, TestPagination,
+            TestCommits, TestPeriod, TestFileStore, TestActivity):
+        suite.addTests(loader.loadTestsFromTestCase(test_case))
+    return suite
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+    test_activity
+
+    Tests the merged activity stream of the projects
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import unittest
+from datetime import datetime, date
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+
+
+class TestActivity(unittest.TestCase):
+    "Test the activity stream"
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid_project')
+        from trytond.modules.nereid_project.activity import ActivityStream
+        self.stream = ActivityStream
+        self.currency_obj = POOL.get('currency.currency')
+        self.company_obj = POOL.get('company.company')
+        self.employee_obj = POOL.get('company.employee')
+        self.nereid_user_obj = POOL.get('nereid.user')
+        self.project_obj = POOL.get('project.work')
+        self.history_obj = POOL.get('project.work.history')
+        self.timesheet_obj = POOL.get('timesheet.line')
+        self.attachment_obj = POOL.get('ir.attachment')
+        self.commit_obj = POOL.get('project.work.commit')
+        self.commit_count = 0
+
+    def _create_defaults(self):
+        """
+        Creates a project with a task, an employee and a nereid user
+        """
+        currency = self.currency_obj.create({
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        })
+        self.company = self.company_obj.create({
+            'name': 'Openlabs',
+            'currency': currency,
+        })
+        self.employee_id = self.employee_obj.create({
+            'name': 'Developer',
+            'company': self.company,
+        })
+        self.user_id = self.nereid_user_obj.create({
+            'name': 'Developer',
+            'display_name': 'Developer',
+            'email': 'developer@example.com',
+            'password': 'password',
+            'company': self.company,
+        })
+        self.project_id = self.project_obj.create({
+            'name': 'ACME',
+            'type': 'project',
+            'company': self.company,
+        })
+        self.task_id = self.project_obj.create({
+            'name': 'Fix the invoice',
+            'type': 'task',
+            'parent': self.project_id,
+            'company': self.company,
+        })
+
+    def _create_entry(self, model, create_date):
+        """
+        Creates an entry of the model in the activity of the task and sets
+        its create date. Returns the (create date, rank, id) of the entry.
+        """
+        task = self.project_obj.browse(self.task_id)
+        if model == 'project.work.history':
+            record_id = self.history_obj.create({
+                'project': self.task_id,
+                'comment': 'Looked into it',
+            })
+        elif model == 'timesheet.line':
+            record_id = self.timesheet_obj.create({
+                'employee': self.employee_id,
+                'work': task.work.id,
+                'hours': 1,
+                'date': date(2012, 5, 1),
+            })
+        elif model == 'ir.attachment':
+            record_id = self.attachment_obj.create({
+                'name': 'notes.txt',
+                'resource': 'project.work,%d' % self.task_id,
+                'type': 'link',
+                'link': 'http://example.com/notes.txt',
+            })
+        else:
+            self.commit_count += 1
+            commit_id = '%040d' % self.commit_count
+            record_id = self.commit_obj.create({
+                'project': self.task_id,
+                'nereid_user': self.user_id,
+                'repository': 'acme',
+                'repository_url': 'https://github.com/openlabs/acme',
+                'commit_message': 'Fix #%d' % self.task_id,
+                'commit_url': 'https://github.com/openlabs/acme/commit/' + \
+                    commit_id,
+                'commit_id': commit_id,
+                'commit_timestamp': create_date,
+            })
+        Transaction().cursor.execute(
+            'UPDATE "' + POOL.get(model)._table + '" '
+            'SET create_date = %s WHERE id = %s', (create_date, record_id)
+        )
+        return create_date, self.stream.SOURCES.index(model), record_id
+
+    def _walk(self, per_page):
+        """
+        Returns the (create date, rank, id) of the entries of the project,
+        read one page after the other with the cursors
+        """
+        project = self.project_obj.browse(self.project_id)
+        entries = []
+        cursor = None
+        while True:
+            stream = self.project_obj.get_activity_stream(
+                project, cursor, per_page
+            )
+            items = stream.items()
+            self.assertTrue(len(items) <= per_page)
+            cursor = stream.next_cursor
+            if cursor is None:
+                entries.append([item.id for item in items])
+                break
+            self.assertEqual(len(items), per_page)
+            # The cursor is the position of the last entry of the page
+            position = self.stream.decode_cursor(cursor)
+            self.assertEqual(position[2], items[-1].id)
+            entries.append(position)
+        return entries
+
+    def test0010_merge(self):
+        """
+        The entries of all the sources are merged newest first, ties on
+        the date broken by source and then by id
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            self._create_defaults()
+            older = datetime(2012, 5, 1, 10, 0)
+            old = datetime(2012, 5, 2, 10, 0)
+            new = datetime(2012, 5, 3, 10, 0)
+            newest = datetime(2012, 5, 3, 10, 0, 0, 1)
+
+            history1 = self._create_entry('project.work.history', new)
+            self._create_entry('project.work.history', older)
+            history3 = self._create_entry('project.work.history', new)
+            line1 = self._create_entry('timesheet.line', new)
+            self._create_entry('timesheet.line', old)
+            self._create_entry('ir.attachment', old)
+            attachment2 = self._create_entry('ir.attachment', newest)
+            commit1 = self._create_entry('project.work.commit', new)
+            self._create_entry('project.work.commit', older)
+
+            project = self.project_obj.browse(self.project_id)
+            everything = self.project_obj.get_activity_stream(
+                project, per_page=100
+            )
+            self.assertEqual(everything.next_cursor, None)
+            self.assertEqual(len(everything), 9)
+            self.assertEqual(self._walk(1)[:5], [
+                attachment2, commit1, line1, history3, history1,
+            ])
+
+            transaction.cursor.rollback()
+
+    def test0020_pages(self):
+        """
+        Walking the pages with the cursors gives every entry once, in the
+        order of the whole stream, whatever the size of the pages
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            self._create_defaults()
+            entries = []
+            for i, model in enumerate([
+                    'project.work.history', 'timesheet.line',
+                    'ir.attachment', 'project.work.commit',
+                    'project.work.history', 'project.work.history',
+                    'ir.attachment', 'timesheet.line', 'project.work.commit',
+                    'project.work.history']):
+                # Every three entries share a date
+                entries.append(self._create_entry(
+                    model, datetime(2012, 5, 1 + i // 3, 10, 0)
+                ))
+            entries.sort(reverse=True)
+
+            for per_page in (1, 2, 3, 4, 10):
+                pages = self._walk(per_page)
+                last_ids = pages.pop()
+                positions = pages
+                self.assertEqual(
+                    positions,
+                    [entries[(i + 1) * per_page - 1]
+                        for i in range(len(positions))]
+                )
+                self.assertEqual(
+                    last_ids,
+                    [entry[2] for entry in entries[len(positions) * per_page:]]
+                )
+
+            # A tampered cursor displays the newest entries
+            project = self.project_obj.browse(self.project_id)
+            stream = self.project_obj.get_activity_stream(
+                project, 'garbage', 2
+            )
+            self.assertEqual(
+                [item.id for item in stream.items()],
+                [entry[2] for entry in entries[:2]]
+            )
+
+            transaction.cursor.rollback()
+
+
+def suite():
+    "Activity stream test suite"
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestActivity)
+    )
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+    test_commits
+
+    Tests the ingestion of the commits received by the repository hooks
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from datetime import datetime
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+
+
+class TestCommits(unittest.TestCase):
+    "Test the ingestion of commits"
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid_project')
+        self.currency_obj = POOL.get('currency.currency')
+        self.company_obj = POOL.get('company.company')
+        self.nereid_user_obj = POOL.get('nereid.user')
+        self.project_obj = POOL.get('project.work')
+        self.commit_obj = POOL.get('project.work.commit')
+        self.hook_obj = POOL.get('project.work.commit.hook')
+        self.repo_path = None
+
+    def tearDown(self):
+        if self.repo_path:
+            shutil.rmtree(self.repo_path)
+
+    def _create_repository(self, messages):
+        """
+        Creates a git repository with an empty commit for each message,
+        oldest first, and returns the ids of the commits newest first as
+        git log lists them
+        """
+        self.repo_path = tempfile.mkdtemp()
+        env = dict(os.environ,
+            GIT_AUTHOR_NAME='Developer',
+            GIT_AUTHOR_EMAIL='developer@example.com',
+            GIT_COMMITTER_NAME='Developer',
+            GIT_COMMITTER_EMAIL='developer@example.com',
+        )
+        subprocess.check_call(
+            ['git', 'init', '-q', self.repo_path], env=env
+        )
+        commit_ids = []
+        for i, message in enumerate(messages):
+            env['GIT_AUTHOR_DATE'] = env['GIT_COMMITTER_DATE'] = \
+                '%d +0000' % (1335868200 + i * 60)
+            message_file = os.path.join(self.repo_path, 'message')
+            with open(message_file, 'wb') as file_:
+                file_.write(message)
+            subprocess.check_call([
+                'git', 'commit', '-q', '--allow-empty', '--cleanup=verbatim',
+                '-F', message_file,
+            ], cwd=self.repo_path, env=env)
+            commit_ids.insert(0, subprocess.Popen(
+                ['git', 'rev-parse', 'HEAD'], cwd=self.repo_path,
+                stdout=subprocess.PIPE
+            ).communicate()[0].strip())
+        return commit_ids
+
+    def _create_defaults(self):
+        """
+        Creates a project with a task and a nereid user
+        """
+        currency = self.currency_obj.create({
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        })
+        company = self.company_obj.create({
+            'name': 'Openlabs',
+            'currency': currency,
+        })
+        self.user_id = self.nereid_user_obj.create({
+            'name': 'Developer',
+            'display_name': 'Developer',
+            'email': 'developer@example.com',
+            'password': 'password',
+            'company': company,
+        })
+        self.project_id = self.project_obj.create({
+            'name': 'ACME',
+            'type': 'project',
+            'company': company,
+        })
+        self.task_id = self.project_obj.create({
+            'name': 'Fix the invoice',
+            'type': 'task',
+            'parent': self.project_id,
+            'company': company,
+        })
+
+    def _commit(self, commit_id, message, email='developer@example.com'):
+        return {
+            'commit_id': commit_id,
+            'message': message,
+            'email': email,
+            'timestamp': datetime(2012, 5, 1, 10, 30),
+            'url': 'https://github.com/openlabs/acme/commit/' + commit_id,
+            'repository': 'acme',
+            'repository_url': 'https://github.com/openlabs/acme',
+        }
+
+    def _github_payload(self, *commits):
+        return json.dumps({
+            'repository': {
+                'name': 'acme',
+                'url': 'https://github.com/openlabs/acme',
+            },
+            'commits': [{
+                'id': commit['commit_id'],
+                'message': commit['message'],
+                'author': {'email': commit['email']},
+                'timestamp': '2012-05-01T10:30:00+05:30',
+                'url': commit['url'],
+            } for commit in commits],
+        })
+
+    def _linked(self):
+        "Returns the (commit id, task id) of the commits linked"
+        return sorted(
+            (commit.commit_id, commit.project.id)
+            for commit in self.commit_obj.browse(self.commit_obj.search([]))
+        )
+
+    def test0010_ingest_commits(self):
+        """
+        Only the references to tasks in the commits of known users are
+        linked
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            self._create_defaults()
+
+            self.assertEqual(self.commit_obj.ingest_commits([
+                self._commit('a' * 40, 'Fix #%d and #%d, see #99999' % (
+                    self.task_id, self.project_id
+                )),
+                self._commit('b' * 40, 'Refs #%d' % self.task_id,
+                    email='stranger@example.com'),
+                self._commit('c' * 40, 'No reference'),
+            ]), 1)
+            self.assertEqual(self._linked(), [('a' * 40, self.task_id)])
+
+            commit, = self.commit_obj.browse(self.commit_obj.search([]))
+            self.assertEqual(commit.nereid_user.id, self.user_id)
+            self.assertEqual(
+                commit.commit_timestamp, datetime(2012, 5, 1, 10, 30)
+            )
+
+            transaction.cursor.rollback()
+
+    def test0020_ingest_commits_idempotent(self):
+        """
+        A commit is linked once to a task however often it is received,
+        within a batch or across batches
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            self._create_defaults()
+            commit = self._commit('a' * 40, 'Fix #%d' % self.task_id)
+
+            self.assertEqual(
+                self.commit_obj.ingest_commits([commit, commit]), 1
+            )
+            self.assertEqual(self.commit_obj.ingest_commits([commit]), 0)
+            self.assertEqual(self.commit_obj.ingest_commits([
+                commit, self._commit('b' * 40, 'Refs #%d' % self.task_id),
+            ]), 1)
+            self.assertEqual(self._linked(), [
+                ('a' * 40, self.task_id), ('b' * 40, self.task_id),
+            ])
+
+            transaction.cursor.rollback()
+
+    def test0030_process_hooks(self):
+        """
+        Redelivered hooks do not duplicate commits and a delivery which
+        fails is marked as failed without undoing the others
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            self._create_defaults()
+            payload = self._github_payload(
+                self._commit('a' * 40, 'Fix #%d' % self.task_id)
+            )
+            first_id = self.hook_obj.create({
+                'source': 'github', 'payload': payload,
+            })
+            broken_id = self.hook_obj.create({
+                'source': 'github', 'payload': '{"commits": [{}]}',
+            })
+            redelivered_id = self.hook_obj.create({
+                'source': 'github', 'payload': payload,
+            })
+
+            self.hook_obj.process_pending()
+            self.assertEqual(self._linked(), [('a' * 40, self.task_id)])
+            commit, = self.commit_obj.browse(self.commit_obj.search([]))
+            # The timezone of the payload is converted to UTC
+            self.assertEqual(
+                commit.commit_timestamp, datetime(2012, 5, 1, 5, 0)
+            )
+
+            first, broken, redelivered = self.hook_obj.browse(
+                [first_id, broken_id, redelivered_id]
+            )
+            self.assertEqual(first.state, 'done')
+            self.assertEqual(broken.state, 'failed')
+            self.assertTrue(broken.error)
+            self.assertEqual(redelivered.state, 'done')
+
+            transaction.cursor.rollback()
+
+    def test0040_iter_git_log(self):
+        """
+        The records and the fields of the log are split whatever the
+        messages contain and however the output is read
+        """
+        from trytond.modules.nereid_project.utils import iter_git_log
+
+        long_body = '\n'.join(['x' * 79] * 1000)
+        messages = [
+            'Fix #1\n\nFirst paragraph\n\nSecond paragraph\n  indented\n',
+            'No reference\n',
+            # Longer than the 64 KiB read by iter_git_log
+            'Refs #2\n\n' + long_body + '\n',
+            u'Close #3: r\xe9sum\xe9\n'.encode('utf-8'),
+        ]
+        commit_ids = self._create_repository(messages)
+
+        commits = list(iter_git_log(self.repo_path, grep=None))
+        self.assertEqual(
+            [commit['commit_id'] for commit in commits], commit_ids
+        )
+        self.assertEqual(
+            [commit['message'] for commit in commits], [
+                u'Close #3: r\xe9sum\xe9',
+                u'Refs #2\n\n' + long_body,
+                u'No reference',
+                u'Fix #1\n\nFirst paragraph\n\nSecond paragraph\n'
+                    u'  indented',
+            ]
+        )
+        for commit in commits:
+            self.assertEqual(commit['email'], u'developer@example.com')
+        self.assertEqual(
+            commits[-1]['timestamp'].replace(tzinfo=None),
+            datetime(2012, 5, 1, 10, 30)
+        )
+        self.assertEqual(commits[-1]['timestamp'].utcoffset().seconds, 0)
+
+        # git filters the commits without a reference
+        self.assertEqual([
+            commit['commit_id'] for commit in iter_git_log(self.repo_path)
+        ], [commit_ids[0], commit_ids[1], commit_ids[3]])
+
+    def test0050_backfill_from_git(self):
+        """
+        The commits of a repository are linked in batches and a second run
+        links nothing more
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            self._create_defaults()
+            commit_ids = self._create_repository([
+                'Fix #%d\n' % self.task_id,
+                'Refs #%d\n' % self.project_id,
+                'Refs #%d again\n' % self.task_id,
+                'Close #%d\n' % self.task_id,
+            ])
+
+            def backfill():
+                return list(self.commit_obj.backfill_from_git(
+                    self.repo_path, 'acme', 'https://github.com/openlabs/acme',
+                    'https://github.com/openlabs/acme/commit/%s',
+                    batch_size=2
+                ))
+            self.assertEqual(backfill(), [2, 1])
+            self.assertEqual(self._linked(), sorted([
+                (commit_ids[0], self.task_id),
+                (commit_ids[1], self.task_id),
+                (commit_ids[3], self.task_id),
+            ]))
+            self.assertEqual(backfill(), [0, 0])
+            self.assertEqual(len(self._linked()), 3)
+
+            transaction.cursor.rollback()
+
+
+def suite():
+    "Commits test suite"
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestCommits)
+    )
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+    test_filestore
+
+    Tests the conditional and range requests of the attachment downloads
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import tempfile
+import unittest
+from datetime import datetime
+
+from flask import Flask
+from werkzeug.http import http_date
+import trytond.tests.test_tryton
+
+
+class TestFileStore(unittest.TestCase):
+    "Test the downloads of the stored files"
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid_project')
+        from trytond.modules.nereid_project import filestore
+        self.filestore = filestore
+        self.app = Flask(__name__)
+
+        # Larger than a block, so the file is streamed in several reads
+        self.data = ''.join(
+            chr(i % 256) for i in range(2 * filestore.BLOCK_SIZE + 100)
+        )
+        file_d, self.filename = tempfile.mkstemp()
+        with os.fdopen(file_d, 'wb') as file_p:
+            file_p.write(self.data)
+        self.etag = 'abc123'
+        self.last_modified = datetime(2012, 5, 1, 10, 30, 15, 250)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def _get(self, headers=None):
+        """
+        Returns the response to a download with the given request headers,
+        and its body
+        """
+        with self.app.test_request_context('/', headers=headers or {}):
+            response = self.filestore.send_stored_file(
+                self.filename, u'report "final".pdf', self.etag,
+                self.last_modified
+            )
+            body = ''.join(response.response or [])
+            response.close()
+        return response, body
+
+    def test0010_full_download(self):
+        """
+        The whole file is streamed with its validators
+        """
+        response, body = self._get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.data)
+        self.assertEqual(response.content_length, len(self.data))
+        self.assertEqual(response.mimetype, 'application/pdf')
+        self.assertEqual(
+            response.headers['Content-Disposition'],
+            'attachment; filename="report final.pdf"'
+        )
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.get_etag(), (self.etag, False))
+        self.assertEqual(
+            response.last_modified, self.last_modified.replace(microsecond=0)
+        )
+
+    def test0020_not_modified(self):
+        """
+        The clients which have the file are answered with a 304 and no
+        body
+        """
+        for headers in [
+                {'If-None-Match': '"%s"' % self.etag},
+                {'If-None-Match': '"other", "%s"' % self.etag},
+                {'If-Modified-Since': http_date(self.last_modified)}]:
+            response, body = self._get(headers)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(body, '')
+
+        # The entity tag takes precedence over the date
+        for headers in [
+                {'If-None-Match': '"other"'},
+                {'If-None-Match': '"other"',
+                    'If-Modified-Since': http_date(self.last_modified)},
+                {'If-Modified-Since': 'Mon, 30 Apr 2012 10:30:15 GMT'}]:
+            response, body = self._get(headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(body, self.data)
+
+    def test0030_range(self):
+        """
+        A single byte range is answered with a 206 and the bytes asked for
+        """
+        size = len(self.data)
+        for range_, begin, end in [
+                ('bytes=0-9', 0, 10),
+                ('bytes=100-%d' % (size + 1000), 100, size),
+                ('bytes=70000-', 70000, size),
+                ('bytes=-500', size - 500, size),
+                ('bytes=-%d' % (size * 2), 0, size)]:
+            response, body = self._get({'Range': range_})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(body, self.data[begin:end])
+            self.assertEqual(response.content_length, end - begin)
+            self.assertEqual(
+                response.headers['Content-Range'],
+                'bytes %d-%d/%d' % (begin, end - 1, size)
+            )
+
+        # A range starting past the end of the file is not satisfiable
+        response, body = self._get({'Range': 'bytes=%d-' % size})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(
+            response.headers['Content-Range'], 'bytes */%d' % size
+        )
+
+    def test0040_range_fallback(self):
+        """
+        The whole file is sent for a range of a changed file and for
+        several ranges
+        """
+        for headers in [
+                {'Range': 'bytes=0-9', 'If-Range': '"other"'},
+                {'Range': 'bytes=0-9,20-29'}]:
+            response, body = self._get(headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(body, self.data)
+
+        response, body = self._get(
+            {'Range': 'bytes=0-9', 'If-Range': '"%s"' % self.etag}
+        )
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.data[:10])
+
+
+def suite():
+    "File store test suite"
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestFileStore)
+    )
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
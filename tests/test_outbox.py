@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+    test_outbox
+
+    Tests the email outbox against a stub SMTP server
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import socket
+import smtplib
+import unittest
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+
+
+class StubSMTPServer(object):
+    """
+    Records the messages it is given. The errors are raised, in order, by
+    the next calls of sendmail. None lets a message through.
+    """
+
+    def __init__(self, errors=None):
+        self.errors = list(errors or [])
+        self.sent = []
+        self.closed = False
+
+    def sendmail(self, from_addr, to_addrs, message):
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error
+        self.sent.append((from_addr, to_addrs, message))
+
+    def quit(self):
+        self.closed = True
+
+
+class TestOutbox(unittest.TestCase):
+    "Test the email outbox"
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid_project')
+        self.outbox_obj = POOL.get('project.work.outbox')
+        # The module of the model, for its RETRY_DELAY and MAX_ATTEMPTS
+        self.outbox = sys.modules[self.outbox_obj.__module__]
+        self.connections = []
+
+    def tearDown(self):
+        if 'get_smtp_server' in self.outbox_obj.__dict__:
+            del self.outbox_obj.get_smtp_server
+
+    def _use_server(self, server):
+        """
+        Makes the outbox connect to the stub server
+        """
+        def get_smtp_server():
+            self.connections.append(server)
+            return server
+        self.outbox_obj.get_smtp_server = get_smtp_server
+
+    def _queue(self, subject):
+        message = MIMEText('Body')
+        message['Subject'] = subject
+        return self.outbox_obj.queue_mail(
+            'from@example.com', ['a@example.com', 'b@example.com'], message
+        )
+
+    def test0010_send_all(self):
+        """
+        The due messages are sent over a single connection
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            server = StubSMTPServer()
+            self._use_server(server)
+            ids = [self._queue('Message %d' % i) for i in range(3)]
+
+            self.outbox_obj.send_all()
+
+            self.assertEqual(len(self.connections), 1)
+            self.assertTrue(server.closed)
+            self.assertEqual(len(server.sent), 3)
+            self.assertEqual(
+                server.sent[0][1], ['a@example.com', 'b@example.com']
+            )
+            for mail in self.outbox_obj.browse(ids):
+                self.assertEqual(mail.state, 'sent')
+                self.assertTrue(mail.sent_date)
+
+            transaction.cursor.rollback()
+
+    def test0020_retry_backoff(self):
+        """
+        A temporary failure is retried later, with a delay doubling at
+        every attempt
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            self._use_server(StubSMTPServer([
+                smtplib.SMTPResponseException(451, 'Try again later'),
+                smtplib.SMTPResponseException(451, 'Try again later'),
+            ]))
+            mail_id = self._queue('Retried')
+
+            before = datetime.utcnow()
+            self.outbox_obj.send_all()
+            mail = self.outbox_obj.browse(mail_id)
+            self.assertEqual(mail.state, 'outbox')
+            self.assertEqual(mail.attempts, 1)
+            self.assertTrue(mail.last_error)
+            self.assertTrue(
+                mail.next_attempt >= before + timedelta(
+                    seconds=self.outbox.RETRY_DELAY
+                ) - timedelta(seconds=1)
+            )
+
+            # The message is not due yet
+            self.outbox_obj.send_all()
+            self.assertEqual(self.outbox_obj.browse(mail_id).attempts, 1)
+
+            self.outbox_obj.write(mail_id, {'next_attempt': before})
+            before = datetime.utcnow()
+            self.outbox_obj.send_all()
+            mail = self.outbox_obj.browse(mail_id)
+            self.assertEqual(mail.attempts, 2)
+            self.assertTrue(
+                mail.next_attempt >= before + timedelta(
+                    seconds=2 * self.outbox.RETRY_DELAY
+                ) - timedelta(seconds=1)
+            )
+
+            # The server accepts the message at the next attempt
+            self.outbox_obj.write(mail_id, {'next_attempt': before})
+            self.outbox_obj.send_all()
+            self.assertEqual(self.outbox_obj.browse(mail_id).state, 'sent')
+
+            transaction.cursor.rollback()
+
+    def test0030_permanent_failure(self):
+        """
+        A permanent failure and too many attempts give up the message
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            self._use_server(StubSMTPServer([
+                smtplib.SMTPResponseException(550, 'No such user'),
+                smtplib.SMTPResponseException(451, 'Try again later'),
+            ]))
+            rejected_id = self._queue('Rejected')
+            exhausted_id = self._queue('Exhausted')
+            self.outbox_obj.write(exhausted_id, {
+                'attempts': self.outbox.MAX_ATTEMPTS - 1,
+            })
+
+            self.outbox_obj.send_all()
+            self.assertEqual(
+                self.outbox_obj.browse(rejected_id).state, 'failed'
+            )
+            self.assertEqual(
+                self.outbox_obj.browse(exhausted_id).state, 'failed'
+            )
+
+            transaction.cursor.rollback()
+
+    def test0040_server_unreachable(self):
+        """
+        The batch stops when the server goes away and the messages left are
+        kept for the next run
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            server = StubSMTPServer([
+                None, smtplib.SMTPServerDisconnected('Connection lost'),
+            ])
+            self._use_server(server)
+            sent_id = self._queue('Sent')
+            failed_id = self._queue('Failed')
+            left_id = self._queue('Left')
+
+            self.outbox_obj.send_all()
+            self.assertEqual(self.outbox_obj.browse(sent_id).state, 'sent')
+            self.assertEqual(self.outbox_obj.browse(failed_id).attempts, 1)
+            left = self.outbox_obj.browse(left_id)
+            self.assertEqual(left.state, 'outbox')
+            self.assertEqual(left.attempts, 0)
+
+            # The next run reconnects and sends the message left
+            self.outbox_obj.send_all()
+            self.assertEqual(len(self.connections), 2)
+            self.assertEqual(self.outbox_obj.browse(left_id).state, 'sent')
+
+            transaction.cursor.rollback()
+
+    def test0050_connection_refused(self):
+        """
+        A failed connection or login, even with a permanent error code,
+        leaves all the messages untouched for the next run
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            errors = [
+                smtplib.SMTPAuthenticationError(535, 'Bad credentials'),
+                smtplib.SMTPConnectError(554, 'No service'),
+                socket.error('Connection refused'),
+            ]
+
+            def get_smtp_server():
+                self.connections.append(None)
+                raise errors.pop(0)
+            self.outbox_obj.get_smtp_server = get_smtp_server
+            ids = [self._queue('Message %d' % i) for i in range(3)]
+
+            for _ in range(3):
+                self.outbox_obj.send_all()
+            self.assertEqual(len(self.connections), 3)
+            for mail in self.outbox_obj.browse(ids):
+                self.assertEqual(mail.state, 'outbox')
+                self.assertEqual(mail.attempts, 0)
+
+            # The messages are sent once the server is back
+            server = StubSMTPServer()
+            self._use_server(server)
+            self.outbox_obj.send_all()
+            self.assertEqual(len(server.sent), 3)
+
+            transaction.cursor.rollback()
+
+    def test0060_purge(self):
+        """
+        The messages sent or failed long ago are deleted, the queued ones
+        and the recent ones are kept
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            self._use_server(StubSMTPServer([
+                None, smtplib.SMTPResponseException(550, 'No such user'),
+            ]))
+            sent_id = self._queue('Sent')
+            failed_id = self._queue('Failed')
+            self.outbox_obj.send_all()
+            recent_id = self._queue('Recent')
+            queued_id = self._queue('Queued')
+            self.outbox_obj.write(recent_id, {'state': 'sent'})
+
+            old_date = datetime.now() - timedelta(
+                days=self.outbox.RETENTION_DAYS + 1
+            )
+            transaction.cursor.execute(
+                'UPDATE "' + self.outbox_obj._table + '" '
+                'SET write_date = %s', (old_date,)
+            )
+            self.outbox_obj.write(recent_id, {'attempts': 0})
+
+            self.outbox_obj.purge()
+            self.assertEqual(
+                sorted(self.outbox_obj.search([])),
+                sorted([recent_id, queued_id])
+            )
+            self.assertFalse(
+                self.outbox_obj.search([('id', 'in', [sent_id, failed_id])])
+            )
+
+            transaction.cursor.rollback()
+
+
+def suite():
+    "Outbox test suite"
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestOutbox)
+    )
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
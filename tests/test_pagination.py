@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+    test_pagination
+
+    Tests the keyset pagination of the task lists
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import json
+import unittest
+from base64 import urlsafe_b64encode
+from datetime import datetime, date
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+
+
+class TestPagination(unittest.TestCase):
+    "Test the keyset pagination"
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid_project')
+        from trytond.modules.nereid_project.pagination import \
+            KeysetPagination
+        self.pagination = KeysetPagination
+        self.currency_obj = POOL.get('currency.currency')
+        self.company_obj = POOL.get('company.company')
+        self.project_obj = POOL.get('project.work')
+
+    def _create_tasks(self, finish_times):
+        """
+        Creates a project with a task for each of the finish times and
+        returns the id of the project and the ids of the tasks
+        """
+        currency = self.currency_obj.create({
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        })
+        company = self.company_obj.create({
+            'name': 'Openlabs',
+            'currency': currency,
+        })
+        project_id = self.project_obj.create({
+            'name': 'ACME',
+            'type': 'project',
+            'company': company,
+        })
+        task_ids = [self.project_obj.create({
+            'name': 'Task %d' % i,
+            'type': 'task',
+            'parent': project_id,
+            'company': company,
+            'constraint_finish_time': finish_time,
+        }) for i, finish_time in enumerate(finish_times)]
+        return project_id, task_ids
+
+    def _pages(self, domain, direction, per_page):
+        """
+        Returns the ids of every page, walking forwards with the next
+        cursors, and checks that walking backwards from the last page with
+        the previous cursors gives the same pages
+        """
+        pages = []
+        cursor = None
+        while True:
+            pagination = self.pagination(
+                self.project_obj, domain, cursor, per_page,
+                'constraint_finish_time', direction
+            )
+            pages.append([task.id for task in pagination])
+            cursor = pagination.next_cursor
+            if cursor is None:
+                break
+
+        backward_pages = [pages[-1]]
+        cursor = pagination.prev_cursor
+        while cursor is not None:
+            pagination = self.pagination(
+                self.project_obj, domain, cursor, per_page,
+                'constraint_finish_time', direction
+            )
+            backward_pages.insert(0, [task.id for task in pagination])
+            cursor = pagination.prev_cursor
+        self.assertEqual(backward_pages, pages)
+        return pages
+
+    def test0010_cursor_round_trip(self):
+        """
+        A cursor decodes to the position it was built from
+        """
+        for value in (
+                datetime(2012, 5, 1, 10, 30, 15, 250), date(2012, 5, 1),
+                None, 42, 2.5, u'Résumé'):
+            for mode in ('n', 'p'):
+                self.assertEqual(
+                    self.pagination.decode_cursor(
+                        self.pagination.encode_cursor(mode, value, 7)
+                    ), (mode, value, 7)
+                )
+
+    def test0020_tampered_cursor(self):
+        """
+        Invalid cursors decode to None and display the first page
+        """
+        tokens = ['', 'garbage', u'caf\xe9', None, 42]
+        tokens.extend(urlsafe_b64encode(json.dumps(position)) for position in [
+            ['n', 1, 'x'], ['n', {}, 1], ['n', [1], 1], ['n', [1, 2, 3], 1],
+            ['n', ['datetime', 'yesterday'], 1], ['n', ['time', '10:00'], 1],
+            ['n', ['date', 20120501], 1], ['x', 1, 1], ['n', 1, True],
+            ['n', 1, [1]], ['n', 1], ['n', 1, 1, 1], 1, {'n': 1}, None,
+        ])
+        for token in tokens:
+            self.assertEqual(self.pagination.decode_cursor(token), None)
+
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            project_id, task_ids = self._create_tasks([None, None, None])
+            domain = [('parent', '=', project_id)]
+            for token in tokens:
+                pagination = self.pagination(
+                    self.project_obj, domain, token, 2,
+                    'constraint_finish_time'
+                )
+                self.assertEqual(
+                    [task.id for task in pagination], task_ids[:2]
+                )
+                self.assertFalse(pagination.has_prev)
+
+            transaction.cursor.rollback()
+
+    def test0030_null_ordering(self):
+        """
+        Ties on the sort field are broken by id and the tasks without a
+        finish time come last in ascending order, first in descending
+        order, whatever the database
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            early = datetime(2012, 5, 1, 10, 0)
+            late = datetime(2012, 5, 2, 10, 0)
+            project_id, task_ids = self._create_tasks(
+                [None, late, early, None, early, late, None]
+            )
+            domain = [('parent', '=', project_id)]
+            ascending = [
+                task_ids[2], task_ids[4], task_ids[1], task_ids[5],
+                task_ids[0], task_ids[3], task_ids[6],
+            ]
+            descending = [
+                task_ids[6], task_ids[3], task_ids[0],
+                task_ids[5], task_ids[1], task_ids[4], task_ids[2],
+            ]
+            for per_page in (1, 2, 3, 10):
+                self.assertEqual(
+                    sum(self._pages(domain, 'ASC', per_page), []), ascending
+                )
+                self.assertEqual(
+                    sum(self._pages(domain, 'DESC', per_page), []),
+                    descending
+                )
+
+            transaction.cursor.rollback()
+
+
+def suite():
+    "Pagination test suite"
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestPagination)
+    )
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
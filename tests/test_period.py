@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+    test_period
+
+    Tests the overlap checks and the date lookup of the work periods
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import unittest
+from datetime import date, datetime
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+
+
+class TestPeriod(unittest.TestCase):
+    "Test the work periods"
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid_project')
+        self.period_obj = POOL.get('project.work.period')
+
+    def _create_period(self, start_date, end_date, active=True):
+        return self.period_obj.create({
+            'name': '%s - %s' % (start_date, end_date),
+            'start_date': start_date,
+            'end_date': end_date,
+            'active': active,
+        })
+
+    def test0010_overlaps(self):
+        """
+        Periods and ranges sharing a day with a period overlap it
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            first_id = self._create_period(date(2012, 5, 1), date(2012, 5, 7))
+            second_id = self._create_period(
+                date(2012, 5, 8), date(2012, 5, 14)
+            )
+            self.assertFalse(self.period_obj._overlaps([first_id, second_id]))
+
+            for start_date, end_date, overlaps in [
+                    (date(2012, 4, 1), date(2012, 4, 30), False),
+                    (date(2012, 4, 1), date(2012, 5, 1), True),
+                    (date(2012, 5, 7), date(2012, 5, 8), True),
+                    (date(2012, 5, 3), date(2012, 5, 4), True),
+                    (date(2012, 4, 1), date(2012, 6, 1), True),
+                    (date(2012, 5, 14), date(2012, 5, 20), True),
+                    (date(2012, 5, 15), date(2012, 5, 20), False)]:
+                self.assertEqual(self.period_obj._overlaps(
+                    start_date=start_date, end_date=end_date
+                ), overlaps)
+
+            # The constraint rejects an overlapping period
+            self.assertRaises(
+                Exception, self._create_period,
+                date(2012, 5, 14), date(2012, 5, 20)
+            )
+
+            transaction.cursor.rollback()
+
+    def test0020_get_period_for_date(self):
+        """
+        A date is found in the active period containing it, boundaries
+        included, and in no period when it falls in a gap
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            # Created out of order, with a gap in between
+            second_id = self._create_period(
+                date(2012, 5, 15), date(2012, 5, 21)
+            )
+            first_id = self._create_period(date(2012, 5, 1), date(2012, 5, 7))
+            inactive_id = self._create_period(
+                date(2012, 6, 1), date(2012, 6, 7), active=False
+            )
+
+            for date_, period_id in [
+                    (date(2012, 4, 30), None),
+                    (date(2012, 5, 1), first_id),
+                    (date(2012, 5, 4), first_id),
+                    (date(2012, 5, 7), first_id),
+                    (date(2012, 5, 8), None),
+                    (date(2012, 5, 14), None),
+                    (date(2012, 5, 15), second_id),
+                    (datetime(2012, 5, 21, 23, 59), second_id),
+                    (date(2012, 5, 22), None),
+                    (date(2012, 6, 3), None)]:
+                self.assertEqual(
+                    self.period_obj.get_period_for_date(date_), period_id
+                )
+
+            # The index is rebuilt when the periods change
+            self.period_obj.write(inactive_id, {'active': True})
+            self.assertEqual(
+                self.period_obj.get_period_for_date(date(2012, 6, 3)),
+                inactive_id
+            )
+            gap_id = self._create_period(date(2012, 5, 8), date(2012, 5, 14))
+            self.assertEqual(
+                self.period_obj.get_period_for_date(date(2012, 5, 10)),
+                gap_id
+            )
+
+            transaction.cursor.rollback()
+
+
+def suite():
+    "Work period test suite"
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestPeriod)
+    )
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+    test_search
+
+    Tests the full text search of the tasks. Run them against SQLite to use
+    the FTS5 backend, or set DB_NAME and the Tryton configuration to test
+    the PostgreSQL backend.
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+
+
+class TestSearch(unittest.TestCase):
+    "Test the full text search of the tasks"
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid_project')
+        self.currency_obj = POOL.get('currency.currency')
+        self.company_obj = POOL.get('company.company')
+        self.project_obj = POOL.get('project.work')
+        self.history_obj = POOL.get('project.work.history')
+        self.search_obj = POOL.get('project.work.search')
+
+    def _create_project(self, name):
+        """
+        Creates a project of a new company
+        """
+        currency = self.currency_obj.create({
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        })
+        self.company = self.company_obj.create({
+            'name': 'Openlabs',
+            'currency': currency,
+        })
+        return self.project_obj.create({
+            'name': name,
+            'type': 'project',
+            'company': self.company,
+        })
+
+    def _create_task(self, project_id, name, comment=None):
+        return self.project_obj.create({
+            'name': name,
+            'type': 'task',
+            'parent': project_id,
+            'company': self.company,
+            'comment': comment,
+        })
+
+    def _is_ranked(self):
+        "The fallback backend does not rank the results"
+        return self.search_obj.get_backend().__class__.__name__ != \
+            'LikeBackend'
+
+    def test0010_search_ranked(self):
+        """
+        Tasks mentioning the term more often come first
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            project_id = self._create_project('ACME')
+            once = self._create_task(
+                project_id, 'Fix the layout',
+                'The footer of the invoice overlaps the page number and '
+                'the address block is misaligned on the second page'
+            )
+            often = self._create_task(
+                project_id, 'Invoice totals',
+                'Invoice totals are wrong on the invoice report'
+            )
+            self._create_task(project_id, 'Unrelated', 'Nothing to see')
+
+            ids = self.search_obj.search_tasks('invoice')
+            self.assertEqual(set(ids), set([once, often]))
+            if self._is_ranked():
+                self.assertEqual(ids, [often, once])
+
+            transaction.cursor.rollback()
+
+    def test0020_search_history_comments(self):
+        """
+        The index is updated when a comment is added to a task
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            project_id = self._create_project('ACME')
+            task_id = self._create_task(project_id, 'Slow reports')
+
+            self.assertEqual(self.search_obj.search_tasks('postgresql'), [])
+            self.history_obj.create({
+                'project': task_id,
+                'comment': 'Upgrading PostgreSQL fixed it',
+            })
+            self.assertEqual(
+                self.search_obj.search_tasks('postgresql'), [task_id]
+            )
+
+            transaction.cursor.rollback()
+
+    def test0030_search_scope(self):
+        """
+        The results are restricted to the domain before they are limited
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT) as transaction:
+            project_id = self._create_project('ACME')
+            other_project_id = self.project_obj.create({
+                'name': 'Other',
+                'type': 'project',
+                'company': self.company,
+            })
+            # The tasks of the other project are better matches
+            for i in range(5):
+                self._create_task(
+                    other_project_id, 'Export %d' % i,
+                    'Export the export file to the export folder'
+                )
+            task_id = self._create_task(
+                project_id, 'Import', 'Check the export first'
+            )
+
+            domain = [
+                ('type', '=', 'task'),
+                ('parent', '=', project_id),
+            ]
+            self.assertEqual(
+                self.search_obj.search_tasks('export', domain, limit=2),
+                [task_id]
+            )
+            self.assertEqual(
+                len(self.search_obj.search_tasks('export', limit=2)), 2
+            )
+            self.assertEqual(
+                self.search_obj.search_tasks('export', domain + [
+                    ('state', '=', 'done'),
+                ]), []
+            )
+
+            transaction.cursor.rollback()
+
+
+def suite():
+    "Search test suite"
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestSearch)
+    )
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+    utils
+
+    Helpers shared by the models of nereid project
+
+    :copyright: (c) 2012 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import hashlib
+import threading
+import subprocess
+from datetime import datetime
+from collections import OrderedDict
+
+import dateutil.tz
+
+from docutils.core import publish_parts
+from flask import g, request, current_app, Response
+from nereid.ctx import has_request_context
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+def request_cache(name):
+    """
+    Returns a dictionary which lives only as long as the current request.
+    This is used to memoize lookups like permission checks which are
+    repeated several times while serving a single request.
+
+    Outside a request context a new dictionary is returned every time, so
+    nothing is memoized.
+
+    :param name: Name of the cache
+    """
+    if not has_request_context():
+        return {}
+    try:
+        caches = g.nereid_project_caches
+    except AttributeError:
+        caches = g.nereid_project_caches = {}
+    return caches.setdefault(name, {})
+
+
+def rule_filtered_sql(model, domain):
+    """
+    Returns the FROM clause, the WHERE clause and the arguments of a query
+    on the records of the model which match the domain and the record rules
+    of the current user, that is the records search would return. The
+    columns of the model must be qualified with its table name.
+
+    :param model: Name of the model
+    :param domain: The domain of the records
+    """
+    pool = Pool()
+    qu1, qu2, tables, tables_args = pool.get(model).search_domain(domain)
+    domain1, domain2 = pool.get('ir.rule').domain_get(model, mode='read')
+    if domain1:
+        qu1 = qu1 and qu1 + ' AND ' + domain1 or domain1
+        qu2 = qu2 + domain2
+    return (
+        ' FROM ' + ' '.join(tables), qu1 and ' WHERE ' + qu1 or '',
+        tables_args + qu2
+    )
+
+
+#: Maximum number of parameters of a statement. This is the default limit
+#: of SQLite; PostgreSQL allows more.
+MAX_PARAMETERS = 999
+
+
+def bulk_insert(table, columns, rows):
+    """
+    Inserts the rows in the table with one statement for every chunk of
+    rows instead of one create for every row. The chunks are sized so no
+    statement has more than MAX_PARAMETERS parameters.
+
+    This bypasses the ORM: the create_uid and create_date columns are
+    filled like the ORM does, but the create method of the model is not
+    called. The caller is responsible for its side effects, or must only
+    insert records for which they do not apply.
+
+    :param table: Name of the table
+    :param columns: List of the column names
+    :param rows: List of tuples of values in the order of the columns
+    """
+    cursor = Transaction().cursor
+    if not rows:
+        return
+    columns = list(columns) + ['create_uid', 'create_date']
+    extra = (Transaction().user, datetime.now())
+    placeholder = '(' + ', '.join(['%s'] * len(columns)) + ')'
+    chunk_size = max(1, min(cursor.IN_MAX, MAX_PARAMETERS // len(columns)))
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        values = []
+        for row in chunk:
+            values.extend(row)
+            values.extend(extra)
+        cursor.execute(
+            'INSERT INTO "' + table + '" ('
+                + ', '.join('"%s"' % column for column in columns) + ') '
+            'VALUES ' + ', '.join([placeholder] * len(chunk)), values
+        )
+
+
+#: Separates the fields and the records in the output of iter_git_log
+GIT_FIELD_SEP, GIT_RECORD_SEP = '\x00', '\x1e'
+
+
+def iter_git_log(repo_path, revisions=('--all',), grep=r'#[0-9]+'):
+    """
+    Yields the commits of a local git repository as dictionaries with the
+    keys commit_id, email, timestamp and message. The output of git log is
+    parsed as it is streamed, so the memory used does not depend on the
+    size of the repository.
+
+    :param repo_path: Path of the git repository
+    :param revisions: The revisions given to git log
+    :param grep: Only commits whose message match this extended regular
+                 expression are listed. The filtering is done by git.
+    """
+    args = [
+        'git', 'log', '--format=%H%x00%ae%x00%at%x00%B%x1e',
+    ]
+    if grep:
+        args.extend(['--extended-regexp', '--grep=' + grep])
+    args.extend(revisions)
+    process = subprocess.Popen(args, cwd=repo_path, stdout=subprocess.PIPE)
+
+    def parse(record):
+        commit_id, email, timestamp, message = \
+            record.lstrip('\n').split(GIT_FIELD_SEP, 3)
+        return {
+            'commit_id': commit_id,
+            'email': email.decode('utf-8', 'replace'),
+            'timestamp': datetime.fromtimestamp(
+                int(timestamp), dateutil.tz.tzutc()
+            ),
+            'message': message.strip().decode('utf-8', 'replace'),
+        }
+
+    buffer = ''
+    while True:
+        data = process.stdout.read(64 * 1024)
+        if not data:
+            break
+        records = (buffer + data).split(GIT_RECORD_SEP)
+        buffer = records.pop()
+        for record in records:
+            yield parse(record)
+    if buffer.strip():
+        yield parse(buffer)
+
+    if process.wait():
+        raise subprocess.CalledProcessError(process.returncode, args)
+
+
+def conditional_json(key, validator, compute, timeout=24 * 60 * 60):
+    """
+    Returns a JSON response which can be answered with a 304 by the client
+    or served from the application cache while the data it depends on does
+    not change.
+
+    The entity tag is derived from the key and the validator. The validator
+    must change whenever the data changes, like the last write date and the
+    number of the records the response is computed from.
+
+    :param key: A tuple identifying the response: the endpoint, its
+                arguments and anything the response depends on like the
+                permissions of the user
+    :param validator: A value which changes when the data changes
+    :param compute: A callable returning the JSON response, called only
+                    when the response is neither cached by the client nor
+                    by the application
+    :param timeout: Seconds for which the response is kept in the cache
+    """
+    etag = hashlib.md5(repr((key, validator))).hexdigest()
+
+    if request.if_none_match and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        cache_key = 'nereid-project-json-%s' % etag
+        data = current_app.cache.get(cache_key)
+        if data is None:
+            data = compute().data
+            current_app.cache.set(cache_key, data, timeout)
+        response = Response(data, mimetype='application/json')
+
+    response.set_etag(etag)
+    # The client must revalidate with the entity tag every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+#: Number of rendered reStructuredText documents kept in memory
+RST_CACHE_SIZE = 512
+
+_rst_cache = OrderedDict()
+_rst_cache_lock = threading.Lock()
+
+
+def rst_to_html(text):
+    """
+    Returns the HTML of a reStructuredText document. docutils is slow, so
+    the HTML is kept in a least recently used cache keyed by the hash of
+    the text, and a document is rendered once however often it is shown.
+
+    File insertion and raw HTML are disabled as the text comes from the
+    users.
+
+    :param text: The reStructuredText source
+    """
+    if not text:
+        return u''
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    key = hashlib.sha1(text).hexdigest()
+
+    with _rst_cache_lock:
+        html = _rst_cache.pop(key, None)
+        if html is not None:
+            # Move the entry to the end, where the recently used are
+            _rst_cache[key] = html
+            return html
+
+    html = publish_parts(
+        text.decode('utf-8'), writer_name='html', settings_overrides={
+            'file_insertion_enabled': False,
+            'raw_enabled': False,
+            'halt_level': 5,
+            'report_level': 5,
+        }
+    )['html_body']
+
+    with _rst_cache_lock:
+        _rst_cache[key] = html
+        while len(_rst_cache) > RST_CACHE_SIZE:
+            _rst_cache.popitem(last=False)
+    return html